@@ -0,0 +1,158 @@
+import argparse
+import os
+import shutil
+import numpy as np
+import pandas as pd
+from typing import List, Optional
+
+from cnn import CNN
+from dataset import IMAGE_EXTENSIONS
+
+
+class ActiveLearner:
+    """Class to choose which unlabeled thermographs are worth labelling next.
+
+    Images are ranked by how uncertain the model is about them. After the top ranked images have been labelled, the
+    model is fine-tuned from its current weights (see CNN.fine_tune) instead of being trained again from ImageNet.
+
+        Example:
+            cnn = CNN()
+            cnn.load(filename)
+            learner = ActiveLearner(cnn)
+            ranking = learner.rank(images, method='mc_dropout')
+            learner.export(ranking, 'to_label/', top_k=200)
+            # ... sort the exported crops into defect/no-defect folders ...
+            cnn.fine_tune(training_dir, validation_dir, epochs=5)
+
+    """
+
+    def __init__(self, cnn: CNN, ensemble: Optional[List[CNN]] = None, threshold: float = 0.5):
+        """ActiveLearner initializer.
+
+        Args:
+            cnn: Trained CNN.
+            ensemble: Additional trained CNNs used by the 'ensemble' method.
+            threshold: Minimum probability to assign an image to the second class ('no-defect').
+
+        """
+        self._cnn = cnn
+        self._ensemble = ensemble or []
+        self._threshold = threshold
+
+    def rank(self, images: List[str], method: str = 'threshold', passes: int = 20, batch_size: int = 32) -> \
+            pd.DataFrame:
+        """Scores a pool of unlabeled images and sorts them from the most to the least uncertain.
+
+        Args:
+            images: Paths to the unlabeled images.
+            method: Uncertainty measure.
+                - 'threshold': Closeness of the probability to the threshold.
+                - 'mc_dropout': Standard deviation of the probabilities of several passes with Dropout active.
+                - 'ensemble': Standard deviation of the probabilities of the CNN and the ensemble models.
+            passes: Number of stochastic passes of the 'mc_dropout' method.
+            batch_size: Number of images evaluated in one iteration.
+
+        Returns:
+            Image paths ('filename'), probability of the second class ('probability') and uncertainty ('uncertainty').
+
+        Raises:
+            ValueError: If the method is not known or the 'ensemble' method is used without ensemble models.
+
+        """
+        if method == 'threshold':
+            filenames, probabilities = self._score(self._cnn, images, batch_size)
+            # 1 when the probability equals the threshold, 0 when it is as far from it as possible
+            distance = np.abs(probabilities - self._threshold) / max(self._threshold, 1 - self._threshold)
+            uncertainty = 1 - distance
+        elif method == 'mc_dropout':
+            filenames, probabilities, uncertainty = [], [], []
+            for batch_filenames, predictions in self._cnn.score_mc_dropout(images, passes, batch_size):
+                filenames.extend(batch_filenames)
+                probabilities.append(predictions.mean(axis=1))
+                uncertainty.append(predictions.std(axis=1))
+            probabilities = np.concatenate(probabilities) if probabilities else np.zeros(0)
+            uncertainty = np.concatenate(uncertainty) if uncertainty else np.zeros(0)
+        elif method == 'ensemble':
+            if not self._ensemble:
+                raise ValueError("The 'ensemble' method requires at least one ensemble model.")
+
+            filenames, probabilities = self._score(self._cnn, images, batch_size)
+            # Only images readable by the main model are scored by the rest of the ensemble
+            members = [probabilities] + [self._score(cnn, filenames, batch_size)[1] for cnn in self._ensemble]
+            probabilities = np.mean(members, axis=0)
+            uncertainty = np.std(members, axis=0)
+        else:
+            raise ValueError("Uncertainty method not supported. Possible values are 'threshold', 'mc_dropout' and "
+                             "'ensemble'.")
+
+        ranking = pd.DataFrame({'filename': filenames, 'probability': probabilities, 'uncertainty': uncertainty})
+
+        return ranking.sort_values('uncertainty', ascending=False, kind='stable').reset_index(drop=True)
+
+    @staticmethod
+    def export(ranking: pd.DataFrame, export_dir: str, top_k: int = 100) -> pd.DataFrame:
+        """Copies the most uncertain images to a folder to be labelled and lists them in a CSV file.
+
+        Args:
+            ranking: Output of rank().
+            export_dir: Path to the folder where the images are copied.
+            top_k: Number of images exported.
+
+        Returns:
+            Exported part of the ranking.
+
+        """
+        os.makedirs(export_dir, exist_ok=True)
+        selection = ranking.head(top_k)
+        for filename in selection['filename']:
+            shutil.copy2(filename, export_dir)
+        selection.to_csv(os.path.join(export_dir, 'ranking.csv'), index=False, float_format='%.4f')
+
+        return selection
+
+    @staticmethod
+    def _score(cnn: CNN, images: List[str], batch_size: int):
+        """Computes the probabilities of a pool of images.
+
+        Args:
+            cnn: Trained CNN.
+            images: Paths to the images.
+            batch_size: Number of images evaluated in one iteration.
+
+        Returns:
+            Paths to the scored images.
+            Probability of the second class ('no-defect') for each image.
+
+        """
+        filenames, probabilities = [], []
+        for batch_filenames, predictions in cnn.score(images, batch_size):
+            filenames.extend(batch_filenames)
+            probabilities.append(predictions)
+
+        return filenames, np.concatenate(probabilities) if probabilities else np.zeros(0)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Rank unlabeled thermographs by model uncertainty.')
+    parser.add_argument('model', help='Relative path to the model file without the extension.')
+    parser.add_argument('pool_dir', help='Folder with the unlabeled images.')
+    parser.add_argument('--export-dir', default='to_label')
+    parser.add_argument('--top-k', type=int, default=100)
+    parser.add_argument('--method', choices=('threshold', 'mc_dropout', 'ensemble'), default='mc_dropout')
+    parser.add_argument('--ensemble', nargs='*', default=[], help='Additional models for the ensemble method.')
+    parser.add_argument('--passes', type=int, default=20)
+    parser.add_argument('--batch-size', type=int, default=32)
+    parser.add_argument('--threshold', type=float, default=0.5)
+    arguments = parser.parse_args()
+
+    def load(filename: str) -> CNN:
+        cnn = CNN()
+        cnn.load(filename)
+        return cnn
+
+    pool = sorted(os.path.join(root, name) for root, dirs, files in os.walk(arguments.pool_dir)
+                  for name in files if name.lower().endswith(IMAGE_EXTENSIONS))
+    learner = ActiveLearner(load(arguments.model), [load(filename) for filename in arguments.ensemble],
+                            arguments.threshold)
+    ranking = learner.rank(pool, arguments.method, arguments.passes, arguments.batch_size)
+    print(learner.export(ranking, arguments.export_dir, arguments.top_k))
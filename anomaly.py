@@ -0,0 +1,234 @@
+import argparse
+import math
+import os
+import numpy as np
+import pandas as pd
+from typing import Iterator, List, Tuple
+
+from cnn import CNN
+from dataset import IMAGE_EXTENSIONS
+
+
+class AnomalyDetector:
+    """Class to score thermographs by their distance to the embeddings of known defect-free strings.
+
+    It does not need defect examples, so it also flags failure types the classifier has never seen. Embeddings are
+    L2-normalized and stored as float16, and they are searched with an inverted file index: they are clustered with
+    k-means and a query is only compared with the embeddings of its n_probe closest clusters. The embeddings are stored
+    grouped by cluster, so every cluster is a contiguous slice of the index.
+
+        Examples:
+            1. Building the index from the defect-free images.
+                detector = AnomalyDetector('ResNet50')
+                detector.fit(images)
+                detector.save('anomaly_index.npz')
+
+            2. Scoring new thermographs.
+                detector = AnomalyDetector.load('anomaly_index.npz')
+                for filenames, scores in detector.score(images):
+                    ...
+
+    """
+
+    def __init__(self, base_model: str = 'ResNet50', neighbours: int = 5, n_probe: int = 4, quantile: float = 0.99):
+        """AnomalyDetector initializer.
+
+        Args:
+            base_model: Pre-trained CNN used to compute the embeddings (see CNN.initialize_feature_extractor).
+            neighbours: Number of nearest defect-free embeddings averaged to score an image.
+            n_probe: Number of clusters searched per image.
+            quantile: Quantile of the scores of the defect-free images used as anomaly threshold.
+
+        """
+        self._base_model = base_model
+        self._neighbours = neighbours
+        self._n_probe = n_probe
+        self._quantile = quantile
+
+        self._cnn = None
+        self._embeddings = None
+        self._centroids = None
+        self._assignments = None
+        self._offsets = None
+        self.threshold = None
+
+    def fit(self, images: List[str], batch_size: int = 32, seed: int = 0):
+        """Builds the index from the embeddings of defect-free images.
+
+        Args:
+            images: Paths to the defect-free images.
+            batch_size: Number of images evaluated in one iteration.
+            seed: Random seed used to initialize the clusters.
+
+        """
+        embeddings = np.concatenate([batch for _, batch in self._embed(images, batch_size)])
+        self._embeddings = embeddings.astype(np.float16)
+
+        # About sqrt(n) clusters keeps both the cluster search and the search within clusters small
+        list_count = max(1, int(math.sqrt(len(embeddings))))
+        self._centroids, self._assignments = self._kmeans(embeddings, list_count, seed)
+        self._group_clusters()
+
+        # Score every defect-free image against the rest (its own embedding is the nearest neighbour)
+        scores = np.concatenate([self._search(embeddings[start:start + batch_size], skip_nearest=True)
+                                 for start in range(0, len(embeddings), batch_size)])
+        self.threshold = float(np.quantile(scores, self._quantile))
+
+    def score(self, images: List[str], batch_size: int = 32) -> Iterator[Tuple[List[str], np.ndarray]]:
+        """Scores images one batch at a time.
+
+        Args:
+            images: Paths to the images.
+            batch_size: Number of images evaluated in one iteration.
+
+        Yields:
+            Paths to the images of the batch. Unreadable images are skipped.
+            Mean cosine distance to the nearest defect-free embeddings; above threshold for anomalies.
+
+        """
+        for filenames, embeddings in self._embed(images, batch_size):
+            yield filenames, self._search(embeddings)
+
+    def save(self, filename: str):
+        """Saves the index to a .npz file.
+
+        Args:
+            filename: Relative path to the file.
+
+        """
+        np.savez(filename, embeddings=self._embeddings, centroids=self._centroids, assignments=self._assignments,
+                 threshold=self.threshold, base_model=self._base_model,
+                 parameters=np.array([self._neighbours, self._n_probe]), quantile=self._quantile)
+
+    @classmethod
+    def load(cls, filename: str) -> 'AnomalyDetector':
+        """Loads an index saved with save().
+
+        Args:
+            filename: Relative path to the file.
+
+        Returns:
+            Anomaly detector.
+
+        """
+        with np.load(filename) as data:
+            neighbours, n_probe = data['parameters'].tolist()
+            detector = cls(str(data['base_model']), neighbours, n_probe, float(data['quantile']))
+            detector._embeddings = data['embeddings']
+            detector._centroids = data['centroids']
+            detector._assignments = data['assignments']
+            detector.threshold = float(data['threshold'])
+        detector._group_clusters()
+
+        return detector
+
+    def _embed(self, images: List[str], batch_size: int) -> Iterator[Tuple[List[str], np.ndarray]]:
+        """Computes the L2-normalized embeddings of images one batch at a time."""
+        if self._cnn is None:
+            self._cnn = CNN()
+            self._cnn.initialize_feature_extractor(self._base_model)
+
+        for filenames, embeddings in self._cnn.embed(images, batch_size):
+            yield filenames, embeddings / (np.linalg.norm(embeddings, axis=1, keepdims=True) + 1e-12)
+
+    def _search(self, queries: np.ndarray, skip_nearest: bool = False) -> np.ndarray:
+        """Computes the mean cosine distance of a batch of embeddings to their nearest indexed neighbours.
+
+        Every probed cluster is compared only with the embeddings of the batch that probe it, and the running nearest
+        neighbours of each embedding are updated. Only one cluster at a time is converted to float32.
+
+        Args:
+            queries: L2-normalized embeddings.
+            skip_nearest: Ignore the nearest neighbour (used to score the indexed embeddings themselves).
+
+        Returns:
+            Anomaly scores.
+
+        """
+        queries = queries.astype(np.float32)
+        n_probe = min(self._n_probe, len(self._centroids))
+        probed = np.argpartition(-queries @ self._centroids.T, n_probe - 1, axis=1)[:, :n_probe]
+
+        k = self._neighbours + int(skip_nearest)
+        nearest = np.full((len(queries), k), -np.inf, dtype=np.float32)
+        for cluster in np.unique(probed):
+            members = self._embeddings[self._offsets[cluster]:self._offsets[cluster + 1]]
+            if not len(members):
+                continue
+
+            rows = np.flatnonzero((probed == cluster).any(axis=1))
+            similarities = np.concatenate([nearest[rows], queries[rows] @ members.astype(np.float32).T], axis=1)
+            nearest[rows] = -np.partition(-similarities, k - 1, axis=1)[:, :k]
+
+        nearest = -np.sort(-nearest, axis=1)
+        if skip_nearest:
+            nearest = nearest[:, 1:]
+        nearest = np.where(np.isfinite(nearest), nearest, -1.0)
+
+        return 1 - nearest.mean(axis=1)
+
+    def _group_clusters(self):
+        """Sorts the indexed embeddings by cluster and computes where each cluster starts."""
+        if np.any(np.diff(self._assignments) < 0):
+            order = np.argsort(self._assignments, kind='stable')
+            self._embeddings = self._embeddings[order]
+            self._assignments = self._assignments[order]
+
+        self._offsets = np.searchsorted(self._assignments, np.arange(len(self._centroids) + 1))
+
+    @staticmethod
+    def _kmeans(embeddings: np.ndarray, list_count: int, seed: int, iterations: int = 20) -> \
+            Tuple[np.ndarray, np.ndarray]:
+        """Clusters L2-normalized embeddings by cosine similarity (spherical k-means).
+
+        Args:
+            embeddings: L2-normalized embeddings.
+            list_count: Number of clusters.
+            seed: Random seed used to choose the initial centroids.
+            iterations: Number of refinement iterations.
+
+        Returns:
+            Centroids.
+            Cluster of each embedding.
+
+        """
+        generator = np.random.default_rng(seed)
+        centroids = embeddings[generator.choice(len(embeddings), list_count, replace=False)].astype(np.float32)
+
+        for _ in range(iterations):
+            assignments = np.argmax(embeddings @ centroids.T, axis=1)
+            for cluster in range(list_count):
+                members = embeddings[assignments == cluster]
+                if len(members):
+                    centroid = members.sum(axis=0)
+                    centroids[cluster] = centroid / (np.linalg.norm(centroid) + 1e-12)
+
+        return centroids, np.argmax(embeddings @ centroids.T, axis=1)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Score thermographs by their distance to defect-free strings.')
+    parser.add_argument('command', choices=('fit', 'score'))
+    parser.add_argument('images_dir', help='Defect-free images (fit) or images to score (score).')
+    parser.add_argument('--index', default='anomaly_index.npz')
+    parser.add_argument('--base-model', default='ResNet50')
+    parser.add_argument('--batch-size', type=int, default=32)
+    parser.add_argument('--output', default='anomaly_scores.csv', help='Scores CSV file (score only).')
+    arguments = parser.parse_args()
+
+    images = sorted(os.path.join(root, name) for root, dirs, files in os.walk(arguments.images_dir)
+                    for name in files if name.lower().endswith(IMAGE_EXTENSIONS))
+
+    if arguments.command == 'fit':
+        detector = AnomalyDetector(arguments.base_model)
+        detector.fit(images, arguments.batch_size)
+        detector.save(arguments.index)
+        print('Indexed {} images. Threshold: {:.4f}'.format(len(images), detector.threshold))
+    else:
+        detector = AnomalyDetector.load(arguments.index)
+        rows = [(filename, score, score > detector.threshold)
+                for filenames, scores in detector.score(images, arguments.batch_size)
+                for filename, score in zip(filenames, scores)]
+        pd.DataFrame(rows, columns=('Image', 'Score', 'Anomaly')).to_csv(arguments.output, index=False,
+                                                                         float_format='%.4f')
+        print(arguments.output)
@@ -0,0 +1,130 @@
+import hashlib
+import json
+import math
+import os
+import numpy as np
+import tensorflow as tf
+from typing import Dict
+
+
+class AugmentationCache:
+    """Class to precompute augmented training epochs once and replay them from disk.
+
+    Random augmentation is CPU bound and different in every run. Caching K augmented epochs makes repeated benchmark
+    and sweep runs skip that cost and train on exactly the same batches. Epochs are replayed cyclically, so a training
+    of more than K epochs sees epoch k and k + K identically augmented.
+
+        Example:
+            cache = AugmentationCache('augmentation_cache')
+            training_generator = cache.sequence(training_generator, epochs=5, key={'seed': 0, ...})
+
+    """
+
+    def __init__(self, cache_dir: str = 'augmentation_cache', dtype: str = 'float32'):
+        """AugmentationCache initializer.
+
+        Args:
+            cache_dir: Folder where the augmented epochs are stored.
+            dtype: Data type of the stored images. 'float16' halves the disk space at the cost of some precision.
+
+        """
+        self._cache_dir = cache_dir
+        self._dtype = dtype
+
+    def sequence(self, generator, epochs: int, key: Dict) -> 'CachedSequence':
+        """Returns a sequence replaying the cached epochs of a generator, writing them first if needed.
+
+        Args:
+            generator: Training data iterator (e.g., returned by flow_from_directory).
+            epochs: Number of augmented epochs cached.
+            key: Parameters identifying the generator content (model, image size, seed...). The image paths and labels
+                 of the generator are always part of the key.
+
+        Returns:
+            Sequence with the same filenames, classes, class_indices, num_classes and samples attributes as the
+            generator.
+
+        """
+        content = dict(key, epochs=epochs, dtype=self._dtype, filenames=list(generator.filenames),
+                       classes=[int(label) for label in generator.classes])
+        digest = hashlib.sha1(json.dumps(content, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+        directory = os.path.join(self._cache_dir, digest[:16])
+
+        if not os.path.exists(os.path.join(directory, 'meta.json')):
+            print('\n\nCaching {} augmented epochs in {}...'.format(epochs, directory))
+            self._write(generator, epochs, directory)
+
+        return CachedSequence(directory, generator)
+
+    def _write(self, generator, epochs: int, directory: str):
+        """Runs the generator for several epochs and stores every batch.
+
+        Args:
+            generator: Training data iterator.
+            epochs: Number of augmented epochs cached.
+            directory: Folder where the epochs are stored.
+
+        """
+        os.makedirs(directory, exist_ok=True)
+        # Samples yielded per epoch, which differ from the number of images when batches are resampled
+        image_count, batch_size = generator.samples, None
+
+        for epoch in range(epochs):
+            images, labels = None, np.zeros(image_count, dtype=np.float32)
+            position = 0
+            for batch in range(len(generator)):
+                x, y = generator[batch]
+                if images is None:
+                    batch_size = len(x)
+                    images = np.lib.format.open_memmap(os.path.join(directory, 'x_{}.npy'.format(epoch)), mode='w+',
+                                                       dtype=self._dtype, shape=(image_count,) + x.shape[1:])
+                images[position:position + len(x)] = x
+                labels[position:position + len(x)] = y
+                position += len(x)
+            generator.on_epoch_end()
+
+            images.flush()
+            del images
+            np.save(os.path.join(directory, 'y_{}.npy'.format(epoch)), labels)
+
+        # Written last: an interrupted cache is never reused
+        with open(os.path.join(directory, 'meta.json'), 'w', encoding='utf-8') as f:
+            json.dump({'epochs': epochs, 'batch_size': batch_size, 'images': image_count}, f)
+
+
+class CachedSequence(tf.keras.utils.Sequence):
+    """Sequence replaying the augmented epochs stored by AugmentationCache. Images are memory-mapped."""
+
+    def __init__(self, directory: str, generator):
+        """CachedSequence initializer.
+
+        Args:
+            directory: Folder where the epochs are stored.
+            generator: Training data iterator the epochs were computed from.
+
+        """
+        with open(os.path.join(directory, 'meta.json'), encoding='utf-8') as f:
+            meta = json.load(f)
+
+        self._batch_size = meta['batch_size']
+        self._images = [np.load(os.path.join(directory, 'x_{}.npy'.format(epoch)), mmap_mode='r')
+                        for epoch in range(meta['epochs'])]
+        self._labels = [np.load(os.path.join(directory, 'y_{}.npy'.format(epoch))) for epoch in range(meta['epochs'])]
+        self._epoch = 0
+
+        self.filenames = generator.filenames
+        self.classes = generator.classes
+        self.class_indices = generator.class_indices
+        self.num_classes = generator.num_classes
+        self.samples = generator.samples
+
+    def __len__(self) -> int:
+        return math.ceil(len(self._labels[0]) / self._batch_size)
+
+    def __getitem__(self, index: int):
+        batch = slice(index * self._batch_size, (index + 1) * self._batch_size)
+
+        return np.asarray(self._images[self._epoch][batch], dtype=np.float32), self._labels[self._epoch][batch]
+
+    def on_epoch_end(self):
+        self._epoch = (self._epoch + 1) % len(self._images)
@@ -0,0 +1,204 @@
+import argparse
+import hashlib
+import json
+import os
+import time
+import traceback
+import pandas as pd
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Dict, List
+
+from cnn import CNN
+from dataset import IMAGE_EXTENSIONS, parse_filename
+from results import Results
+
+
+class BatchRunner:
+    """Class to classify the thermographs of many survey flights with a single loaded model.
+
+    Every flight gets its own results folder, named after the flight folder and a short hash of its absolute path, so
+    flights with the same folder name (e.g., '2023_08_01/flight_a' and '2023_08_02/flight_a') never share it. A flight
+    is marked as finished only after its results have been written, so an interrupted run can be restarted and it will
+    skip the flights already processed.
+
+        Example:
+            cnn = CNN()
+            cnn.load(filename)
+            runner = BatchRunner(cnn, 'batch_results/', workers=4)
+            runner.run(['flights/2023_08_01_a', 'flights/2023_08_01_b'])
+
+    """
+
+    def __init__(self, cnn: CNN, output_dir: str, workers: int = 2, batch_size: int = 32, threshold: float = 0.5):
+        """BatchRunner initializer.
+
+        Args:
+            cnn: Trained CNN shared by every worker.
+            output_dir: Path where the per flight results and the summary are stored.
+            workers: Number of flights processed concurrently.
+            batch_size: Number of images evaluated in one iteration.
+            threshold: Minimum probability to assign an image to the second class ('no-defect').
+
+        """
+        self._cnn = cnn
+        self._output_dir = output_dir
+        self._workers = workers
+        self._batch_size = batch_size
+        self._threshold = threshold
+
+    def run(self, flight_dirs: List[str]) -> pd.DataFrame:
+        """Classifies every image of the flights not processed yet and summarizes the results of all of them.
+
+        A flight that fails is reported and left unfinished; the rest of the flights are still processed.
+
+        Args:
+            flight_dirs: Relative paths to the flight directories.
+
+        Returns:
+            Number of images and predicted defects per flight and date.
+
+        Raises:
+            ValueError: If a flight directory is given more than once.
+
+        """
+        keys = [self._flight_key(flight_dir) for flight_dir in flight_dirs]
+        if len(set(keys)) < len(keys):
+            duplicated = sorted({flight_dir for flight_dir, key in zip(flight_dirs, keys) if keys.count(key) > 1})
+            raise ValueError("Flight directories given more than once: {}.".format(', '.join(duplicated)))
+
+        os.makedirs(self._output_dir, exist_ok=True)
+        pending = [flight_dir for flight_dir in flight_dirs if not os.path.exists(self._done_filename(flight_dir))]
+        print('Flights: {} ({} already processed)'.format(len(flight_dirs), len(flight_dirs) - len(pending)))
+
+        images, start = 0, time.perf_counter()
+        with ThreadPoolExecutor(max_workers=self._workers) as executor:
+            futures = {executor.submit(self._process, flight_dir): flight_dir for flight_dir in pending}
+            for future in as_completed(futures):
+                try:
+                    summary = future.result()
+                except Exception:
+                    print('\nFlight {} failed:\n{}'.format(futures[future], traceback.format_exc()))
+                    continue
+
+                images += summary['images']
+                print('{}: {} images, {} defects, {:.1f} images/s'.format(
+                    futures[future], summary['images'], summary['defects'], summary['images_per_second']))
+
+        elapsed = time.perf_counter() - start
+        if images:
+            print('\nOverall: {} images in {:.1f} s ({:.1f} images/s)'.format(images, elapsed, images / elapsed))
+
+        summary_df = self.summary(flight_dirs)
+        summary_df.to_csv(os.path.join(self._output_dir, 'summary.csv'), index=False)
+
+        return summary_df
+
+    def summary(self, flight_dirs: List[str]) -> pd.DataFrame:
+        """Aggregates the results of the finished flights.
+
+        Args:
+            flight_dirs: Relative paths to the flight directories.
+
+        Returns:
+            Number of images and predicted defects per flight and date.
+
+        """
+        rows = []
+        for flight_dir in flight_dirs:
+            filename = self._done_filename(flight_dir)
+            if not os.path.exists(filename):
+                continue
+
+            with open(filename, encoding='utf-8') as f:
+                summary = json.load(f)
+            for date, counts in sorted(summary['dates'].items()):
+                rows.append((flight_dir, date, counts['images'], counts['defects']))
+
+        return pd.DataFrame(rows, columns=('Flight', 'Date', 'Images', 'Defects'))
+
+    def _process(self, flight_dir: str) -> Dict:
+        """Classifies the images of a flight, writes its results and marks it as finished.
+
+        Args:
+            flight_dir: Relative path to the flight directory.
+
+        Returns:
+            Summary of the flight results.
+
+        """
+        images = sorted(os.path.join(root, name) for root, dirs, files in os.walk(flight_dir)
+                        for name in files if name.lower().endswith(IMAGE_EXTENSIONS))
+
+        results_folder = os.path.join(self._output_dir, self._flight_key(flight_dir)) + '/'
+        os.makedirs(results_folder, exist_ok=True)
+
+        class_indices = self._cnn.class_indices
+        defect = class_indices.get('defect', 0)
+        results = Results(class_indices, dataset_name=self._flight_name(flight_dir))
+        results_filename = results.open(results_folder)
+
+        dates: Dict[str, Dict[str, int]] = {}
+        count, start = 0, time.perf_counter()
+        if images:
+            for filenames, predictions in self._cnn.score(images, self._batch_size):
+                predicted_labels = (predictions >= self._threshold).astype(int)
+                results.write("", filenames, predicted_labels, predictions)
+
+                for filename, predicted in zip(filenames, predicted_labels):
+                    timestamp = parse_filename(filename)[1]
+                    counts = dates.setdefault(timestamp.date().isoformat() if timestamp else 'unknown',
+                                              {'images': 0, 'defects': 0})
+                    counts['images'] += 1
+                    counts['defects'] += int(predicted == defect)
+                count += len(filenames)
+        results.close()
+        elapsed = time.perf_counter() - start
+
+        summary = {
+            'flight': os.path.normpath(flight_dir).replace('\\', '/'),
+            'results': results_filename,
+            'images': count,
+            'defects': sum(counts['defects'] for counts in dates.values()),
+            'seconds': elapsed,
+            'images_per_second': count / elapsed if elapsed else 0.0,
+            'dates': dates,
+        }
+
+        # Write the marker atomically so a crash never leaves a flight half marked as finished
+        filename = self._done_filename(flight_dir)
+        with open(filename + '.tmp', 'w', encoding='utf-8') as f:
+            json.dump(summary, f, ensure_ascii=False, indent=4, sort_keys=True)
+        os.replace(filename + '.tmp', filename)
+
+        return summary
+
+    def _done_filename(self, flight_dir: str) -> str:
+        """Path to the summary file written when a flight is finished."""
+        return os.path.join(self._output_dir, self._flight_key(flight_dir), 'done.json')
+
+    @staticmethod
+    def _flight_name(flight_dir: str) -> str:
+        """Name of the flight folder."""
+        return os.path.basename(os.path.normpath(flight_dir))
+
+    @staticmethod
+    def _flight_key(flight_dir: str) -> str:
+        """Name of the results folder of a flight: flight folder name and a hash of its absolute path."""
+        digest = hashlib.sha1(os.path.normcase(os.path.abspath(flight_dir)).encode('utf-8')).hexdigest()
+        return '{}_{}'.format(BatchRunner._flight_name(flight_dir), digest[:8])
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Classify the thermographs of many survey flights.')
+    parser.add_argument('model', help='Relative path to the model file without the extension.')
+    parser.add_argument('flight_dirs', nargs='+', help='Flight directories.')
+    parser.add_argument('--output-dir', default='batch_results')
+    parser.add_argument('--workers', type=int, default=2)
+    parser.add_argument('--batch-size', type=int, default=32)
+    parser.add_argument('--threshold', type=float, default=0.5)
+    arguments = parser.parse_args()
+
+    cnn = CNN()
+    cnn.load(arguments.model)
+    runner = BatchRunner(cnn, arguments.output_dir, arguments.workers, arguments.batch_size, arguments.threshold)
+    print(runner.run(arguments.flight_dirs))
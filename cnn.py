@@ -2,12 +2,33 @@ import json
 import matplotlib.pyplot as plt
 import numpy as np
 import os
+import pandas as pd
+import random
+import threading
+import time
+
+from dataset import file_hash, list_directory
+from runtime import RuntimeProfile
+
+# oneDNN options are read when TensorFlow is loaded, so the profile of this host is applied before importing it
+RuntimeProfile.load().apply_environment()
+
 import tensorflow as tf
 from tensorflow.keras.regularizers import L2,L1, l1_l2
 
 from sys import platform
+from typing import Dict, Iterator, List, Optional, Tuple, Union
 
+from augmentation import AugmentationCache
+from experiments import ExperimentStore
+from registry import ModelRegistry
 from results import Results
+from sampling import BalancedSequence, ClassRecall
+from thermal import ThermalSequence, normalize_frame
+
+# Class indices assigned by flow_from_directory to the 'strings' dataset folders. Used when the model was not trained
+# in this session.
+DEFAULT_CLASS_INDICES = {'defect': 0, 'no-defect': 1}
 
 if platform == "darwin":
     # Fix macOS error "OMP: Error #15: Initializing libiomp5.dylib, but found libiomp5.dylib already initialized."
@@ -29,23 +50,59 @@ class CNN:
                 cnn.load(filename)
                 cnn.predict(test_dir)
 
+            3. Training and evaluating the CNN from the splits of a dataset manifest (see dataset.Dataset).
+                cnn = CNN()
+                cnn.train(dataset.dataframe('train'), dataset.dataframe('validation'), base_model='ResNet50')
+                cnn.predict(results_folder, dataset.dataframe('validation'))
+
+            4. Versioning the trained CNN in a model registry and loading its latest version (see registry.py).
+                cnn.save_version(ModelRegistry('models'), 'strings')
+                cnn = CNN()
+                cnn.load_version(ModelRegistry('models'), 'strings')
+
     """
 
-    def __init__(self):
-        """CNN transfer learning class initializer."""
+    def __init__(self, runtime_profile: Optional[RuntimeProfile] = None,
+                 experiment_store: Optional[ExperimentStore] = None):
+        """CNN transfer learning class initializer.
+
+        Args:
+            runtime_profile: Threading configuration. None to use the saved profile of this host (see runtime.py).
+            experiment_store: Store where the training and prediction runs are recorded. When given, training metrics
+                              are recorded there instead of in TensorBoard logs (see experiments.py).
+
+        """
+        self._runtime_profile = runtime_profile or RuntimeProfile.load()
+        self._runtime_profile.apply()
+
         self._model_name = ""
         self._model = None
         self._target_size = None
         self._preprocessing_function = None
+        self._channels = 3
+        self._class_indices = None
+        self._seed = None
+        self._deterministic = False
+        self._metrics = {}
+        self._predict_lock = threading.Lock()
+
+        self._experiment_store = experiment_store
+        self._run_id = None
+        self._model_path = ""
+        self._model_hash = ""
 
-    def train(self, training_dir: str, validation_dir: str, base_model: str, epochs: int = 1,
+    def train(self, training_dir: Union[str, pd.DataFrame], validation_dir: Union[str, pd.DataFrame], base_model: str, epochs: int = 1,
               unfreezed_convolutional_layers: int = 50, training_batch_size: int = 32, validation_batch_size: int = 32,
-              learning_rate: float = 1e-4, beta_1: float = 0.7, beta_2: float = 0.99, epsilon: float = 0.1):
+              learning_rate: float = 1e-4, beta_1: float = 0.7, beta_2: float = 0.99, epsilon: float = 0.1,
+              channels: int = 3, seed: Optional[int] = None, deterministic: bool = False, cached_epochs: int = 0,
+              cache_dir: str = 'augmentation_cache', sampling: str = ""):
         """Use transfer learning or fine-tuning to train a base network to classify new categories.
 
         Args:
-            training_dir: Relative path to the training directory (e.g., 'dataset/training').
-            validation_dir: Relative path to the validation directory (e.g., 'dataset/validation').
+            training_dir: Relative path to the training directory (e.g., 'dataset/training') or dataset manifest
+                          dataframe with 'filename' and 'class' columns.
+            validation_dir: Relative path to the validation directory (e.g., 'dataset/validation') or dataset manifest
+                            dataframe with 'filename' and 'class' columns.
             base_model: Pre-trained CNN { DenseNet121, DenseNet169, DenseNet201, InceptionResNetV2, InceptionV3,
                                           MobileNet, MobileNetV2, NASNetLarge, NASNetMobile, ResNet50, VGG16, VGG19,
                                           Xception }.
@@ -54,12 +111,628 @@ class CNN:
             training_batch_size: Number of training examples used in one iteration.
             validation_batch_size: Number of validation examples used in one iteration.
             learning_rate: Optimizer learning rate.
+            channels: 3 to train on the pseudo-colour JPEG images; 1 to train on the single-channel radiometric
+                      frames (see thermal.read_temperature).
+            seed: Random seed of Python, NumPy, TensorFlow, the data shuffling and the data augmentation. None for a
+                  different run every time.
+            deterministic: Use deterministic TensorFlow operations and a single data loading worker, so two runs with
+                           the same seed give identical results (slower). Requires a seed. Deterministic operations
+                           stay enabled for the rest of the process.
+            cached_epochs: Number of augmented training epochs precomputed and replayed from disk (see
+                           augmentation.py). 0 to augment the images on the fly.
+            cache_dir: Folder where the augmented epochs are stored.
+            sampling: Class-balanced sampling of the training batches (see sampling.BalancedSequence).
+                - '': No rebalancing; every image is used once per epoch.
+                - 'weighted': Images are drawn with a probability inversely proportional to the size of their class.
+                - 'stratified': Every batch has the same number of images of each class.
+
+        Raises:
+            ValueError: If deterministic is True and no seed is given.
 
         """
+        self._set_seed(seed, deterministic)
+
         # Initialize a base pre-trained CNN without the classification layer
-        self._initialize_base_model(base_model, unfreezed_convolutional_layers, include_top=False)
+        self._initialize_base_model(base_model, unfreezed_convolutional_layers, include_top=False, channels=channels)
 
         # Configure loading and pre-processing/data augmentation functions
+        training_generator, validation_generator = self._read_training_data(training_dir, validation_dir,
+                                                                            training_batch_size, validation_batch_size)
+        if sampling:
+            training_generator = BalancedSequence(training_generator, sampling, seed)
+        if cached_epochs:
+            key = {'base_model': base_model, 'channels': channels, 'target_size': self._target_size, 'seed': seed,
+                   'batch_size': training_batch_size, 'sampling': sampling}
+            training_generator = AugmentationCache(cache_dir).sequence(training_generator, cached_epochs, key)
+
+        # Add a new softmax output layer to learn the training dataset classes
+        #
+        self._add_output_layers(training_generator.num_classes)
+        self._class_indices = training_generator.class_indices
+
+        parameters = {
+            'mode': 'train', 'training_dir': self._describe(training_dir),
+            'validation_dir': self._describe(validation_dir), 'base_model': base_model, 'epochs': epochs,
+            'unfreezed_convolutional_layers': unfreezed_convolutional_layers,
+            'training_batch_size': training_batch_size, 'validation_batch_size': validation_batch_size,
+            'learning_rate': learning_rate, 'beta_1': beta_1, 'beta_2': beta_2, 'epsilon': epsilon,
+            'channels': channels, 'seed': seed, 'deterministic': deterministic, 'cached_epochs': cached_epochs,
+            'sampling': sampling,
+        }
+        self._fit(training_generator, validation_generator, epochs, learning_rate, beta_1, beta_2, epsilon, parameters)
+
+    def fine_tune(self, training_dir: Union[str, pd.DataFrame], validation_dir: Union[str, pd.DataFrame], epochs: int = 5,
+                  training_batch_size: int = 32, validation_batch_size: int = 32, learning_rate: float = 1e-5,
+                  beta_1: float = 0.7, beta_2: float = 0.99, epsilon: float = 0.1):
+        """Continues training the current (trained or loaded) model instead of starting again from ImageNet weights.
+
+        The layers frozen when the model was created are kept frozen.
+
+        Args:
+            training_dir: Relative path to the training directory (e.g., 'dataset/training') or dataset manifest
+                          dataframe with 'filename' and 'class' columns.
+            validation_dir: Relative path to the validation directory (e.g., 'dataset/validation') or dataset manifest
+                            dataframe with 'filename' and 'class' columns.
+            epochs: Number of times the entire dataset is passed forward and backward through the neural network.
+            training_batch_size: Number of training examples used in one iteration.
+            validation_batch_size: Number of validation examples used in one iteration.
+            learning_rate: Optimizer learning rate. Lower than the training one to keep what was already learned.
+
+        """
+        self._continue_training(training_dir, validation_dir, epochs, training_batch_size, validation_batch_size,
+                                learning_rate, beta_1, beta_2, epsilon)
+
+    def update(self, filename: str, new_training_dir: Union[str, pd.DataFrame],
+               old_training_dir: Union[str, pd.DataFrame], validation_dir: Union[str, pd.DataFrame],
+               replay_ratio: float = 1.0, epochs: int = 3, training_batch_size: int = 32, validation_batch_size: int = 32,
+               learning_rate: float = 1e-5, seed: int = 0, tolerance: float = 0.01) -> Dict[str, float]:
+        """Loads a saved model and fine-tunes it on new data mixed with a replay sample of the old training data.
+
+        Only replay_ratio old images are replayed per new image, so the update time grows with the amount of new data
+        and not with the size of the whole corpus.
+
+        Args:
+            filename: Relative path to the saved model file without the extension.
+            new_training_dir: Relative path to the new training directory or dataset manifest dataframe.
+            old_training_dir: Relative path to the training directory the model was trained on or dataset manifest
+                              dataframe.
+            validation_dir: Relative path to the validation directory or dataset manifest dataframe.
+            replay_ratio: Number of old training images replayed per new image. The sample keeps the class proportions.
+            epochs: Number of times the mixed dataset is passed forward and backward through the neural network.
+            training_batch_size: Number of training examples used in one iteration.
+            validation_batch_size: Number of validation examples used in one iteration.
+            learning_rate: Optimizer learning rate.
+            seed: Random seed used to draw the replay sample.
+            tolerance: Maximum validation AUC decrease not reported as a regression.
+
+        Returns:
+            Validation AUC before ('auc_before') and after ('auc_after') the update, and whether it regressed
+            ('regressed').
+
+        """
+        self.load(filename)
+
+        new_df = new_training_dir if isinstance(new_training_dir, pd.DataFrame) else list_directory(new_training_dir)
+        old_df = old_training_dir if isinstance(old_training_dir, pd.DataFrame) else list_directory(old_training_dir)
+
+        replay_fraction = min(1.0, replay_ratio * len(new_df) / max(len(old_df), 1))
+        replay_df = old_df.groupby('class', group_keys=False).sample(frac=replay_fraction, random_state=seed)
+        training_df = pd.concat([new_df, replay_df], ignore_index=True)
+        print('\n\nUpdating with {} new and {} replayed images...'.format(len(new_df), len(replay_df)))
+
+        auc_before = self._evaluate_auc(validation_dir, validation_batch_size)
+        self._continue_training(training_df, validation_dir, epochs, training_batch_size, validation_batch_size,
+                                learning_rate, mode='update')
+        auc_after = self._evaluate_auc(validation_dir, validation_batch_size)
+
+        report = {'auc_before': auc_before, 'auc_after': auc_after, 'regressed': auc_after < auc_before - tolerance}
+        print('\nValidation AUC: {:.4f} -> {:.4f}{}'.format(auc_before, auc_after,
+                                                            ' (REGRESSION)' if report['regressed'] else ''))
+
+        return report
+
+    def predict(self, results_folder: str, test_dir: Union[str, pd.DataFrame], dataset_name: str = "", save: bool = True, threshold:float=0.5,
+                streaming: bool = False, batch_size: int = 32, chunk_size: int = 10000):
+        """Evaluates a new set of images using the trained CNN.
+
+        Args:
+            results_folder : (String) This is the path where the results are going to be stored.
+            test_dir: Relative path to the validation directory (e.g., 'dataset/test') or dataset manifest dataframe
+                      with 'filename' and 'class' columns.
+            dataset_name: Dataset descriptive name.
+            save: Save results to an Excel file.
+            threshold: Minimum probability to assign an image to the second class ('no-defect').
+            streaming: Evaluate batch by batch with bounded memory (except for the list of image paths). Per image
+                       results are appended to a CSV file instead of being collected in an Excel file.
+            batch_size: Number of test examples evaluated in one iteration in streaming mode.
+            chunk_size: Number of per image rows buffered before they are written to disk in streaming mode.
+
+        """
+        start = time.perf_counter()
+        if streaming:
+            images, accuracy, auc, results_path = self._predict_streaming(results_folder, test_dir, dataset_name, save,
+                                                                          threshold, batch_size, chunk_size)
+            self._track_prediction(test_dir, threshold, streaming, batch_size, time.perf_counter() - start, images,
+                                   accuracy, auc, results_path)
+            return
+
+        # Configure loading and pre-processing functions
+        print('Reading test data...')
+        test_datagen = tf.keras.preprocessing.image.ImageDataGenerator(preprocessing_function=self._preprocessing_function)
+
+        test_generator = self._flow(
+            test_datagen,
+            test_dir,
+            target_size=self._target_size,
+            batch_size=1,  # A batch size of 1 ensures that all test images are processed
+            class_mode='binary',
+            shuffle=False
+        )
+
+        # Predict categories
+        predictions = self._model.predict(test_generator, workers=self._runtime_profile.workers)
+        # predicted_labels = np.argmax(predictions, axis=1).ravel().tolist()
+        predicted_labels = [1 if element >= threshold else 0 for element in predictions]
+        print(predicted_labels)
+        # Format results and compute classification statistics
+        results = Results(test_generator.class_indices, dataset_name=dataset_name)
+        accuracy, confusion_matrix, classification = results.compute(self._folder(test_dir),test_generator.filenames, test_generator.classes,
+                                                                     predicted_labels)
+        # Display and save results
+        results.print(accuracy, confusion_matrix)
+        print(results_folder)
+        results_path = ""
+        if save:
+            results_path = results.save(confusion_matrix, classification, predictions, results_folder)
+
+        self._track_prediction(test_dir, threshold, streaming, 1, time.perf_counter() - start, len(predictions),
+                               accuracy, Results.auc(test_generator.classes, predictions), results_path)
+
+    def _predict_streaming(self, results_folder: str, test_dir: Union[str, pd.DataFrame], dataset_name: str, save: bool,
+                           threshold: float, batch_size: int, chunk_size: int) -> Tuple[int, float, float, str]:
+        """Evaluates a new set of images batch by batch, keeping only the confusion matrix in memory.
+
+        The memory used by the predictions and the per image results does not depend on the number of images. The image
+        iterator still lists every image path and label up front (a few hundred bytes per image), so 10^6 images need
+        a few hundred MB for the file list alone.
+
+        Args:
+            results_folder: Path where the results are going to be stored.
+            test_dir: Relative path to the test directory (e.g., 'dataset/test') or dataset manifest dataframe.
+            dataset_name: Dataset descriptive name.
+            save: Save per image results to a CSV file.
+            threshold: Minimum probability to assign an image to the second class ('no-defect').
+            batch_size: Number of test examples evaluated in one iteration.
+            chunk_size: Number of per image rows buffered before they are written to disk.
+
+        Returns:
+            Number of images evaluated.
+            Classification accuracy.
+            Area under the ROC curve.
+            Path to the per image results file (empty if not saved).
+
+        """
+        # Configure loading and pre-processing functions
+        print('Reading test data...')
+        test_datagen = tf.keras.preprocessing.image.ImageDataGenerator(preprocessing_function=self._preprocessing_function)
+
+        test_generator = self._flow(
+            test_datagen,
+            test_dir,
+            target_size=self._target_size,
+            batch_size=batch_size,
+            class_mode='binary',
+            shuffle=False
+        )
+
+        results = Results(test_generator.class_indices, dataset_name=dataset_name)
+        results_path = results.open(results_folder, chunk_size) if save else ""
+        print(results_path)
+
+        # Load the next batches in background threads while the current one is evaluated
+        enqueuer = tf.keras.utils.OrderedEnqueuer(test_generator, use_multiprocessing=False, shuffle=False)
+        enqueuer.start(workers=self._runtime_profile.workers)
+        batches = enqueuer.get()
+
+        # Predict categories and update the classification statistics one batch at a time
+        accuracy, confusion_matrix = results.update([], [])
+        try:
+            for batch in range(len(test_generator)):
+                images, true_labels = next(batches)
+                predictions = self._model.predict_on_batch(images).ravel()
+                predicted_labels = (predictions >= threshold).astype(int)
+
+                accuracy, confusion_matrix = results.update(true_labels, predicted_labels, predictions)
+                if save:
+                    start = batch * batch_size
+                    filenames = test_generator.filenames[start:start + len(predictions)]
+                    results.write(self._folder(test_dir), filenames, predicted_labels, predictions)
+        finally:
+            enqueuer.stop()
+            results.close()
+
+        # Display results
+        results.print(accuracy, confusion_matrix)
+
+        return int(confusion_matrix.sum()), accuracy, results.streaming_auc(), results_path
+
+    def benchmark(self, test_dir: Union[str, pd.DataFrame], batch_size: int = 32, steps: int = 4) -> float:
+        """Measures the inference throughput of the model on a sample of images.
+
+        The first batch is used to warm up the model and it is not measured. The sample is cycled over until the given
+        number of full batches has been measured, so small samples give stable measurements too.
+
+        Args:
+            test_dir: Relative path to a directory with one subfolder per class or dataset manifest dataframe.
+            batch_size: Number of images evaluated in one iteration.
+            steps: Number of batches measured.
+
+        Returns:
+            Images per second.
+
+        Raises:
+            ValueError: If the sample has fewer images than a batch or steps is not a positive number.
+
+        """
+        if steps < 1:
+            raise ValueError("steps must be a positive integer.")
+
+        test_datagen = tf.keras.preprocessing.image.ImageDataGenerator(preprocessing_function=self._preprocessing_function)
+        test_generator = self._flow(test_datagen, test_dir, target_size=self._target_size, batch_size=batch_size,
+                                    class_mode='binary', shuffle=False)
+        if len(test_generator.filenames) < batch_size:
+            raise ValueError("The sample has {} images, fewer than a batch of {}.".format(
+                len(test_generator.filenames), batch_size))
+
+        # The enqueuer starts over at the end of every epoch
+        enqueuer = tf.keras.utils.OrderedEnqueuer(test_generator, use_multiprocessing=False, shuffle=False)
+        enqueuer.start(workers=self._runtime_profile.workers)
+        batches = enqueuer.get()
+
+        try:
+            self._model.predict_on_batch(next(batches)[0])
+
+            images = 0
+            start = time.perf_counter()
+            while images < steps * batch_size:
+                x = next(batches)[0]
+                # The last batch of an epoch is usually smaller and it would bias the measurement
+                if len(x) == batch_size:
+                    images += len(self._model.predict_on_batch(x))
+            elapsed = time.perf_counter() - start
+        finally:
+            enqueuer.stop()
+
+        return images / elapsed
+
+    def score(self, images: List[str], batch_size: int = 32) -> Iterator[Tuple[List[str], np.ndarray]]:
+        """Computes the model output for unlabeled images one batch at a time.
+
+        It can be called from several threads sharing this instance: images are loaded concurrently and the model
+        calls are serialized (each one already uses every TensorFlow thread).
+
+        Args:
+            images: Paths to the images.
+            batch_size: Number of images evaluated in one iteration.
+
+        Yields:
+            Paths to the images of the batch. Unreadable images are skipped.
+            Probability of the second class ('no-defect') for each image of the batch.
+
+        """
+        for filenames, x in self._read_unlabeled_data(images, batch_size):
+            with self._predict_lock:
+                predictions = self._model.predict_on_batch(x).ravel()
+            yield filenames, predictions
+
+    def score_mc_dropout(self, images: List[str], passes: int = 20, batch_size: int = 32) -> \
+            Iterator[Tuple[List[str], np.ndarray]]:
+        """Computes several stochastic model outputs per image keeping the Dropout layers active (MC dropout).
+
+        The base model runs once per batch; only the small classification head is evaluated once per pass, with all
+        the passes of a batch stacked in a single call.
+
+        Args:
+            images: Paths to the images.
+            passes: Number of stochastic outputs per image.
+            batch_size: Number of images evaluated in one iteration.
+
+        Yields:
+            Paths to the images of the batch. Unreadable images are skipped.
+            Probabilities of the second class ('no-defect') with shape (images of the batch, passes).
+
+        """
+        base_model, head = self._model.layers[0], self._model.layers[1:]
+
+        @tf.function
+        def mc_dropout(x):
+            features = tf.repeat(base_model(x, training=False), passes, axis=0)
+            for layer in head:
+                features = layer(features, training=isinstance(layer, tf.keras.layers.Dropout))
+            return tf.reshape(features, (-1, passes))
+
+        for filenames, x in self._read_unlabeled_data(images, batch_size):
+            with self._predict_lock:
+                predictions = mc_dropout(tf.constant(x)).numpy()
+            yield filenames, predictions
+
+    def grad_cam(self, images: List[str], batch_size: int = 32, class_name: str = 'defect', layer_name: str = "") -> \
+            Iterator[Tuple[List[str], np.ndarray, np.ndarray]]:
+        """Computes Grad-CAM class activation maps, one gradient pass per batch.
+
+        Every image only influences its own output, so the gradient of the sum of the batch outputs gives the gradients
+        of all the images at once.
+
+        Args:
+            images: Paths to the images.
+            batch_size: Number of images evaluated in one iteration.
+            class_name: Class whose evidence is located.
+            layer_name: Convolutional layer of the base model explained. Empty for the last one.
+
+        Yields:
+            Paths to the images of the batch. Unreadable images are skipped.
+            Probability of the second class ('no-defect') for each image of the batch.
+            Activation maps normalized to [0, 1], at the resolution of the layer (e.g., 7x7 for ResNet50).
+
+        """
+        base_model, head = self._model.layers[0], self._model.layers[1:]
+        if not layer_name:
+            layer_name = next(layer.name for layer in reversed(base_model.layers) if len(layer.output.shape) == 4)
+        conv_model = tf.keras.Model(base_model.inputs, [base_model.get_layer(layer_name).output, base_model.output])
+        explained_class = self.class_indices[class_name]
+
+        @tf.function
+        def grad_cam(x):
+            with tf.GradientTape() as tape:
+                feature_maps, features = conv_model(x, training=False)
+                for layer in head:
+                    features = layer(features, training=False)
+                probabilities = features[:, 0]
+                scores = probabilities if explained_class == 1 else 1 - probabilities
+
+            gradients = tape.gradient(scores, feature_maps)
+            weights = tf.reduce_mean(gradients, axis=(1, 2), keepdims=True)
+            heatmaps = tf.nn.relu(tf.reduce_sum(weights * feature_maps, axis=-1))
+            heatmaps /= tf.reduce_max(heatmaps, axis=(1, 2), keepdims=True) + tf.keras.backend.epsilon()
+
+            return probabilities, heatmaps
+
+        for filenames, x in self._read_unlabeled_data(images, batch_size):
+            with self._predict_lock:
+                probabilities, heatmaps = grad_cam(tf.constant(x))
+            yield filenames, probabilities.numpy(), heatmaps.numpy()
+
+    def initialize_feature_extractor(self, base_model: str, channels: int = 3):
+        """Initializes a pre-trained base model with ImageNet weights and average pooling to compute embeddings.
+
+        Args:
+            base_model: Pre-trained CNN { DenseNet121, DenseNet169, DenseNet201, InceptionResNetV2, InceptionV3,
+                                          MobileNet, MobileNetV2, NASNetLarge, NASNetMobile, ResNet50, VGG16, VGG19,
+                                          Xception }.
+            channels: Number of input channels (3 for the pseudo-colour images, 1 for radiometric frames).
+
+        """
+        self._initialize_base_model(base_model, 0, include_top=False, pooling='avg', channels=channels)
+
+    def embed(self, images: List[str], batch_size: int = 32) -> Iterator[Tuple[List[str], np.ndarray]]:
+        """Computes the base model embeddings of images one batch at a time.
+
+        Args:
+            images: Paths to the images.
+            batch_size: Number of images evaluated in one iteration.
+
+        Yields:
+            Paths to the images of the batch. Unreadable images are skipped.
+            Globally pooled output of the base model for each image of the batch.
+
+        """
+        base_model = self._model.layers[0] if isinstance(self._model, tf.keras.models.Sequential) else self._model
+
+        for filenames, x in self._read_unlabeled_data(images, batch_size):
+            with self._predict_lock:
+                embeddings = base_model.predict_on_batch(x)
+            yield filenames, embeddings
+
+    @property
+    def class_indices(self) -> Dict[str, int]:
+        """Dictionary relating textual and numeric labels of the model outputs."""
+        return self._class_indices or DEFAULT_CLASS_INDICES
+
+    def load(self, filename: str):
+        """Loads a trained CNN model and the corresponding preprocessing information.
+
+        Args:
+           filename: Relative path to the file without the extension.
+
+        """
+        # Load Keras model
+        self._model = tf.keras.models.load_model(filename + '.h5', custom_objects={'ClassRecall': ClassRecall})
+        self._channels = self._model.input_shape[-1]
+        self._model_path = filename + '.h5'
+        self._model_hash = file_hash(self._model_path) if self._experiment_store else ""
+
+        # Load base model information. Models saved without it are named after their base model (e.g., 'ResNet50_...')
+        if os.path.exists(filename + '.json'):
+            with open(filename + '.json', encoding='utf-8') as f:
+                information = json.load(f)
+            self._model_name = information['base_model']
+            self._class_indices = information.get('class_indices')
+        else:
+            self._model_name = filename.split("_")[0]
+        self._initialize_attributes()
+
+    def save(self, filename: str):
+        """Saves the model to an .h5 file and the base model name and class indices to a .json file.
+
+        Args:
+           filename: Relative path to the file without the extension.
+
+        """
+        # Save Keras model
+        self._model.save(filename + '.h5')
+        self._model_path = filename + '.h5'
+
+        # Link the model file to the training run that produced it
+        if self._experiment_store and self._run_id is not None:
+            self._experiment_store.set_model(self._run_id, self._model_path)
+            self._model_hash = file_hash(self._model_path)
+
+        # Save base model information
+        with open(filename + '.json', 'w', encoding='utf-8') as f:
+            json.dump({'base_model': self._model_name, 'class_indices': self.class_indices}, f, ensure_ascii=False,
+                      indent=4, sort_keys=True)
+
+    def save_version(self, registry: ModelRegistry, name: str, threshold: float = 0.5,
+                     metrics: Optional[Dict[str, float]] = None) -> int:
+        """Stores the model as a new version in a model registry.
+
+        Args:
+           registry: Model registry.
+           name: Model name in the registry.
+           threshold: Minimum probability to assign an image to the second class ('no-defect').
+           metrics: Metrics stored with the version. Defaults to the metrics of the last training epoch.
+
+        Returns:
+            Version number.
+
+        """
+        return registry.save(name, self._model, {
+            'base_model': self._model_name,
+            'target_size': list(self._target_size),
+            'channels': self._channels,
+            'threshold': threshold,
+            'class_indices': self.class_indices,
+            'metrics': self._metrics if metrics is None else metrics,
+        })
+
+    def load_version(self, registry: ModelRegistry, name: str, version: Optional[int] = None,
+                     mmap: bool = True) -> Dict:
+        """Loads a version of a model from a model registry.
+
+        Args:
+           registry: Model registry.
+           name: Model name in the registry.
+           version: Version number. None for the latest version.
+           mmap: Memory-map the weights file instead of reading it whole.
+
+        Returns:
+            Version configuration (threshold, metrics...).
+
+        """
+        self._model, config = registry.load(name, version, mmap)
+        self._model_name = config['base_model']
+        self._channels = config['channels']
+        self._class_indices = config['class_indices']
+        self._metrics = config['metrics']
+        self._model_path = os.path.join(name, str(config['version']))
+        self._model_hash = ""
+        self._initialize_attributes()
+
+        return config
+
+    def export(self, directory: str, threshold: float = 0.5):
+        """Exports the model to a self-contained SavedModel that classifies raw JPEG images.
+
+        Decoding, resizing, pre-processing, the model and the threshold all run inside the TensorFlow graph, so serving
+        requires neither this class nor any per image Python code. The model metadata is stored in the 'metadata'
+        signature.
+
+            Example:
+                served = tf.saved_model.load(directory)
+                outputs = served.signatures['serving_default'](images=tf.constant([jpeg_bytes_1, jpeg_bytes_2]))
+
+        Args:
+           directory: Relative path to the SavedModel directory.
+           threshold: Minimum probability to assign an image to the second class ('no-defect').
+
+        Raises:
+            ValueError: If the model takes single-channel radiometric frames.
+
+        """
+        if self._channels != 3:
+            raise ValueError("Only models trained on the pseudo-colour JPEG images can be exported.")
+
+        model = self._model
+        target_size = self._target_size
+        preprocessing_function = self._preprocessing_function
+
+        class_names = [key for key, value in sorted(self.class_indices.items(), key=lambda x: x[1])]
+
+        def decode(image: tf.Tensor) -> tf.Tensor:
+            image = tf.io.decode_jpeg(image, channels=3)
+            # Nearest neighbour interpolation matches the resizing done by flow_from_directory
+            return tf.cast(tf.image.resize(image, target_size, method='nearest'), tf.float32)
+
+        @tf.function(input_signature=[tf.TensorSpec(shape=[None], dtype=tf.string, name='images')])
+        def serve(images):
+            batch = tf.map_fn(decode, images, fn_output_signature=tf.float32)
+            probabilities = tf.reshape(model(preprocessing_function(batch), training=False), [-1])
+            labels = tf.cast(probabilities >= threshold, tf.int32)
+            return {
+                'probabilities': probabilities,
+                'labels': labels,
+                'classes': tf.gather(tf.constant(class_names), labels),
+            }
+
+        @tf.function(input_signature=[])
+        def metadata():
+            return {
+                'base_model': tf.constant(self._model_name),
+                'target_size': tf.constant(target_size, dtype=tf.int32),
+                'threshold': tf.constant(threshold, dtype=tf.float32),
+                'class_names': tf.constant(class_names),
+            }
+
+        module = tf.Module()
+        module.model = model
+        module.serve = serve
+        module.metadata = metadata
+        tf.saved_model.save(module, directory, signatures={'serving_default': serve, 'metadata': metadata})
+
+    def _set_seed(self, seed: Optional[int], deterministic: bool):
+        """Seeds every random number generator used during training.
+
+        The seed and the number of data loading workers of a previous training are always replaced, so a later unseeded
+        training is random again. Deterministic TensorFlow operations cannot be disabled once enabled: they stay on for
+        the rest of the process.
+
+        Args:
+            seed: Random seed. None to leave the generators unseeded.
+            deterministic: Use deterministic TensorFlow operations.
+
+        Raises:
+            ValueError: If deterministic is True and no seed is given.
+
+        """
+        if deterministic and seed is None:
+            raise ValueError("A seed is required for deterministic training.")
+
+        self._seed = seed
+        self._deterministic = deterministic
+
+        if seed is not None:
+            random.seed(seed)
+            np.random.seed(seed)
+            tf.random.set_seed(seed)
+
+        if deterministic:
+            tf.config.experimental.enable_op_determinism()
+
+    def _read_training_data(self, training_dir: Union[str, pd.DataFrame], validation_dir: Union[str, pd.DataFrame],
+                            training_batch_size: int, validation_batch_size: int):
+        """Configures the loading and pre-processing/data augmentation of the training and validation images.
+
+        Args:
+            training_dir: Relative path to the training directory or dataset manifest dataframe.
+            validation_dir: Relative path to the validation directory or dataset manifest dataframe.
+            training_batch_size: Number of training examples used in one iteration.
+            validation_batch_size: Number of validation examples used in one iteration.
+
+        Returns:
+            Training data iterator.
+            Validation data iterator.
+
+        """
         print('\n\nReading training and validation data...')
         training_datagen = tf.keras.preprocessing.image.ImageDataGenerator(
             preprocessing_function=self._preprocessing_function,
@@ -74,32 +747,121 @@ class CNN:
 
         validation_datagen = tf.keras.preprocessing.image.ImageDataGenerator(preprocessing_function=self._preprocessing_function)
 
-        training_generator = training_datagen.flow_from_directory(
+        training_generator = self._flow(
+            training_datagen,
             training_dir,
             target_size=self._target_size,
             batch_size=training_batch_size,
-            class_mode='binary'
+            class_mode='binary',
+            seed=self._seed
         )
 
-        validation_generator = validation_datagen.flow_from_directory(
+        validation_generator = self._flow(
+            validation_datagen,
             validation_dir,
             target_size=self._target_size,
             batch_size=validation_batch_size,
             class_mode='binary',
-            shuffle=False
+            shuffle=False,
+            seed=self._seed
         )
 
-        # Add a new softmax output layer to learn the training dataset classes
-        #
-        self._add_output_layers(training_generator.num_classes)
+        return training_generator, validation_generator
+
+    def _read_unlabeled_data(self, images: List[str], batch_size: int) -> Iterator[Tuple[List[str], np.ndarray]]:
+        """Loads and pre-processes unlabeled images in background workers.
+
+        Args:
+            images: Paths to the images.
+            batch_size: Number of images per batch.
+
+        Yields:
+            Paths to the images of the batch. Unreadable images are skipped.
+            Pre-processed images of the batch.
+
+        """
+        datagen = tf.keras.preprocessing.image.ImageDataGenerator(preprocessing_function=self._preprocessing_function)
+        generator = self._flow(datagen, pd.DataFrame({'filename': images}), target_size=self._target_size,
+                               batch_size=batch_size, class_mode=None, shuffle=False)
+
+        enqueuer = tf.keras.utils.OrderedEnqueuer(generator, use_multiprocessing=False, shuffle=False)
+        enqueuer.start(workers=self._runtime_profile.workers)
+        batches = enqueuer.get()
+
+        try:
+            for batch in range(len(generator)):
+                x = next(batches)
+                start = batch * batch_size
+                yield generator.filenames[start:start + len(x)], x
+        finally:
+            enqueuer.stop()
+
+    def _evaluate_auc(self, test_dir: Union[str, pd.DataFrame], batch_size: int) -> float:
+        """Computes the area under the ROC curve of the model on a labelled set of images.
+
+        Args:
+            test_dir: Relative path to a directory with one subfolder per class or dataset manifest dataframe.
+            batch_size: Number of images evaluated in one iteration.
+
+        Returns:
+            Area under the ROC curve.
+
+        """
+        test_datagen = tf.keras.preprocessing.image.ImageDataGenerator(preprocessing_function=self._preprocessing_function)
+        test_generator = self._flow(test_datagen, test_dir, target_size=self._target_size, batch_size=batch_size,
+                                    class_mode='binary', shuffle=False)
+        predictions = self._model.predict(test_generator, workers=self._runtime_profile.workers)
+
+        return Results.auc(test_generator.classes, predictions)
+
+    def _continue_training(self, training_dir: Union[str, pd.DataFrame], validation_dir: Union[str, pd.DataFrame],
+                           epochs: int, training_batch_size: int, validation_batch_size: int, learning_rate: float,
+                           beta_1: float = 0.7, beta_2: float = 0.99, epsilon: float = 0.1,
+                           mode: str = 'fine_tune'):
+        """Trains the current model further (see fine_tune).
 
+        Args:
+            mode: 'fine_tune' or 'update'. Run kind recorded in the experiment store.
+
+        """
+        training_generator, validation_generator = self._read_training_data(training_dir, validation_dir,
+                                                                            training_batch_size, validation_batch_size)
+        self._class_indices = training_generator.class_indices
+
+        parameters = {
+            'mode': mode, 'model_path': self._model_path, 'training_dir': self._describe(training_dir),
+            'validation_dir': self._describe(validation_dir), 'base_model': self._model_name, 'epochs': epochs,
+            'training_batch_size': training_batch_size, 'validation_batch_size': validation_batch_size,
+            'learning_rate': learning_rate, 'beta_1': beta_1, 'beta_2': beta_2, 'epsilon': epsilon,
+        }
+        self._fit(training_generator, validation_generator, epochs, learning_rate, beta_1, beta_2, epsilon, parameters)
+
+    def _fit(self, training_generator, validation_generator, epochs: int, learning_rate: float, beta_1: float,
+             beta_2: float, epsilon: float, parameters: Optional[Dict] = None):
+        """Compiles and trains the model.
+
+        Args:
+            training_generator: Training data iterator.
+            validation_generator: Validation data iterator.
+            epochs: Number of times the entire dataset is passed forward and backward through the neural network.
+            learning_rate: Optimizer learning rate.
+            parameters: Hyperparameters recorded in the experiment store. Their 'mode' ('train', 'fine_tune' or
+                        'update') is recorded as the run kind.
+
+        Returns:
+            Training history.
+
+        """
         # Compile the model
         optimizer = tf.keras.optimizers.Adam(learning_rate=learning_rate, beta_1=beta_1, beta_2=beta_2, epsilon=epsilon)
         #optimizer = tf.keras.optimizers.RMSprop(learning_rate=learning_rate, momentum=momentum)
+        # The recall of every class (e.g., 'val_defect_recall') is reported after each epoch
+        class_recalls = [ClassRecall(index, name=name.replace('-', '_') + '_recall')
+                         for name, index in sorted(self.class_indices.items(), key=lambda x: x[1])]
         self._model.compile(
             optimizer=optimizer,
             loss='binary_crossentropy',
-            metrics=['accuracy', tf.keras.metrics.AUC()],
+            metrics=['accuracy', tf.keras.metrics.AUC()] + class_recalls,
         )
 
         # Display a summary of the model
@@ -118,10 +880,16 @@ class CNN:
             embeddings_data=None, update_freq='epoch'
         )
 
-        callbacks = [tensorboard_callback]
+        if self._experiment_store:
+            parameters = parameters or {}
+            self._run_id = self._experiment_store.start_run(parameters.get('mode', 'train'), parameters)
+            callbacks = [self._experiment_store.callback(self._run_id)]
+        else:
+            callbacks = [tensorboard_callback]
 
         # Train the network
         print("\n\nTraining CNN...")
+        start = time.perf_counter()
 
         history = self._model.fit(
             training_generator,
@@ -129,82 +897,53 @@ class CNN:
             steps_per_epoch=len(training_generator),
             validation_data=validation_generator,
             validation_steps=len(validation_generator),
-            callbacks=callbacks
+            callbacks=callbacks,
+            # Concurrent workers would draw the random augmentations in a different order on every run
+            workers=1 if self._deterministic else self._runtime_profile.workers
         )
 
+        self._metrics = {key: float(values[-1]) for key, values in history.history.items()}
+
+        if self._experiment_store:
+            # The name of the AUC metric gets a suffix when several instances have been created (e.g., 'val_auc_1')
+            auc_key = next((key for key in history.history if key.startswith('val_auc')), None)
+            self._experiment_store.finish_run(
+                self._run_id, time.perf_counter() - start, images=training_generator.samples * epochs,
+                accuracy=history.history['val_accuracy'][-1], auc=history.history[auc_key][-1] if auc_key else None
+            )
+
         # Plot model training history
         if epochs > 1:
             self._plot_training(history)
 
-    def predict(self, results_folder: str, test_dir: str, dataset_name: str = "", save: bool = True, threshold:float=0.5):
-        """Evaluates a new set of images using the trained CNN.
+        return history
 
-        Args:
-            results_folder : (String) This is the path where the results are going to be stored.
-            test_dir: Relative path to the validation directory (e.g., 'dataset/test').
-            dataset_name: Dataset descriptive name.
-            save: Save results to an Excel file.
-
-        """
-        # Configure loading and pre-processing functions
-        print('Reading test data...')
-        test_datagen = tf.keras.preprocessing.image.ImageDataGenerator(preprocessing_function=self._preprocessing_function)
-
-        test_generator = test_datagen.flow_from_directory(
-            test_dir,
-            target_size=self._target_size,
-            batch_size=1,  # A batch size of 1 ensures that all test images are processed
-            class_mode='binary',
-            shuffle=False
-        )
-
-        # Predict categories
-        predictions = self._model.predict(test_generator)
-        # predicted_labels = np.argmax(predictions, axis=1).ravel().tolist()
-        predicted_labels = [1 if element >= threshold else 0 for element in predictions]
-        print(predicted_labels)
-        # Format results and compute classification statistics
-        results = Results(test_generator.class_indices, dataset_name=dataset_name)
-        accuracy, confusion_matrix, classification = results.compute(test_dir,test_generator.filenames, test_generator.classes,
-                                                                     predicted_labels)
-        # Display and save results
-        results.print(accuracy, confusion_matrix)
-        print(results_folder)
-        if save:
-            results.save(confusion_matrix, classification, predictions, results_folder)
-
-    def load(self, filename: str):
-        """Loads a trained CNN model and the corresponding preprocessing information.
+    def _track_prediction(self, test_dir: Union[str, pd.DataFrame], threshold: float, streaming: bool,
+                          batch_size: int, seconds: float, images: int, accuracy: float, auc: float, results_path: str):
+        """Records a prediction run in the experiment store, if any.
 
         Args:
-           filename: Relative path to the file without the extension.
+            test_dir: Relative path to the test directory or dataset manifest dataframe.
+            threshold: Minimum probability to assign an image to the second class ('no-defect').
+            streaming: Whether the streaming evaluation mode was used.
+            batch_size: Number of test examples evaluated in one iteration.
+            seconds: Duration of the prediction.
+            images: Number of images evaluated.
+            accuracy: Classification accuracy.
+            auc: Area under the ROC curve.
+            results_path: Path to the results file (empty if not saved).
 
         """
-        # Load Keras model
-        self._model = tf.keras.models.load_model(filename + '.h5')
+        if not self._experiment_store:
+            return
 
-        # # Load base model information
-        # with open(filename + '.json') as f:
-        #     self._model_name = json.load(f)
-        self._model_name = filename.split("_")[0]
-        self._initialize_attributes()
-
-    def save(self, filename: str):
-        """Saves the model to an .h5 file and the model name to a .json file.
-
-        Args:
-           filename: Relative path to the file without the extension.
-
-        """
-        # Save Keras model
-        self._model.save(filename + '.h5')
-
-        # # Save base model information
-        # with open(filename + '.json', 'w', encoding='utf-8') as f:
-        #     json.dump(self._model_name, f, ensure_ascii=False, indent=4, sort_keys=True)
+        parameters = {'test_dir': self._describe(test_dir), 'base_model': self._model_name, 'threshold': threshold,
+                      'streaming': streaming, 'batch_size': batch_size}
+        run_id = self._experiment_store.start_run('predict', parameters, self._model_path, self._model_hash)
+        self._experiment_store.finish_run(run_id, seconds, images, float(accuracy), float(auc), results_path)
 
     def _initialize_base_model(self, base_model: str, unfreezed_convolutional_layers: int, include_top: bool = True,
-                               pooling: str = 'avg'):
+                               pooling: str = 'avg', channels: int = 3):
         """Initializes the base model.
 
         Args:
@@ -218,6 +957,8 @@ class CNN:
                 - 'avg': Global average pooling will be applied to the output of the last convolutional block, and thus
                          the output of the model will be a 2D tensor.
                 - 'max': Global max pooling will be applied.
+            channels: Number of input channels. With 1 channel, the ImageNet weights of the first convolution are
+                      summed over the RGB channels.
 
         Raises:
             TypeError: If the unfreezed_convolutional_layers parameter is not an integer.
@@ -226,6 +967,7 @@ class CNN:
 
         """
         self._model_name = base_model
+        self._channels = channels
         self._initialize_attributes()
 
         input_shape = self._target_size + (3,)
@@ -235,6 +977,18 @@ class CNN:
         self._model = getattr(tf.keras.applications, base_model)(weights='imagenet', include_top=include_top,
                                                               input_shape=input_shape, pooling=pooling)
 
+        if channels == 1:
+            # Same network with a single-channel input. Every weight is copied except the kernel of the first
+            # convolution, whose RGB input channels are summed (the response to a grey image is preserved).
+            model = getattr(tf.keras.applications, base_model)(weights=None, include_top=include_top,
+                                                            input_shape=self._target_size + (1,), pooling=pooling)
+            for layer, pretrained_layer in zip(model.layers, self._model.layers):
+                layer.set_weights([weights.sum(axis=2, keepdims=True) if weights.ndim == 4 and weights.shape[2] == 3
+                                   and layer_weights.shape[2] == 1 else weights
+                                   for weights, layer_weights in zip(pretrained_layer.get_weights(),
+                                                                     layer.get_weights())])
+            self._model = model
+
         # Freeze convolutional layers
         if type(unfreezed_convolutional_layers) != int:
             raise TypeError("unfreezed_convolutional_layers must be a positive integer.")
@@ -252,6 +1006,8 @@ class CNN:
     def _initialize_attributes(self):
         """Initialize the input image shape along with the pre-processing function.
 
+        Models with a single input channel take radiometric frames, which are normalized frame by frame instead.
+
         Raises:
             ValueError: If the model is unknown.
 
@@ -294,6 +1050,9 @@ class CNN:
                              "'DenseNet201', 'InceptionResNetV2', 'InceptionV3', 'MobileNet', 'MobileNetV2', "
                              "'NASNetLarge', 'NASNetMobile', 'ResNet50', 'VGG16', 'VGG19' and 'Xception'.")
 
+        if self._channels == 1:
+            self._preprocessing_function = normalize_frame
+
     def _add_output_layers(self, class_count: int, fc_layer_size: int = 1024):
         """Append a fully-connected shallow neural network with softmax outputs at the end of the base model.
 
@@ -319,6 +1078,55 @@ class CNN:
         # Assign the new model to the class attribute
         self._model = model
 
+    def _flow(self, datagen: tf.keras.preprocessing.image.ImageDataGenerator, source: Union[str, pd.DataFrame],
+              **kwargs):
+        """Creates an iterator over the images of a directory or of a dataset manifest dataframe.
+
+        Models with a single input channel read the radiometric frames of the images instead (see thermal.py).
+
+        Args:
+            datagen: Data generator with the loading and pre-processing/data augmentation functions.
+            source: Relative path to a directory with one subfolder per class or dataframe with the image paths
+                    ('filename') and labels ('class').
+            **kwargs: Arguments forwarded to flow_from_directory or flow_from_dataframe.
+
+        Returns:
+            Iterator yielding batches of images and labels.
+
+        """
+        if self._channels == 1:
+            return ThermalSequence(datagen, list_directory(source) if isinstance(source, str) else source, **kwargs)
+
+        if isinstance(source, str):
+            return datagen.flow_from_directory(source, **kwargs)
+
+        return datagen.flow_from_dataframe(source, x_col='filename', y_col='class', **kwargs)
+
+    def _folder(self, source: Union[str, pd.DataFrame]) -> str:
+        """Returns the folder the image paths of the iterator created by _flow are relative to.
+
+        Args:
+            source: Relative path to a directory or dataset manifest dataframe (whose paths are not relative).
+
+        Returns:
+            Folder path; empty for dataframes and for single-channel models, whose iterator lists the full paths.
+
+        """
+        return source if isinstance(source, str) and self._channels != 1 else ""
+
+    @staticmethod
+    def _describe(source: Union[str, pd.DataFrame]) -> str:
+        """Describes a directory or dataset manifest dataframe for the experiment store.
+
+        Args:
+            source: Relative path to a directory or dataset manifest dataframe.
+
+        Returns:
+            Directory path or number of images of the dataframe.
+
+        """
+        return source if isinstance(source, str) else '<dataframe: {} images>'.format(len(source))
+
     @staticmethod
     def _plot_training(history):
         """Plots the evolution of the accuracy and the loss of both the training and validation sets.
@@ -0,0 +1,280 @@
+import argparse
+import hashlib
+import os
+import random
+import re
+import sqlite3
+import pandas as pd
+from datetime import datetime
+from typing import Dict, List, Optional, Tuple
+
+# Crops are named after the DJI thermograph they were cut from, e.g. '102DJI_20230801132321_0147_T.JPG' is the crop
+# number 102 of the frame 'DJI_20230801132321_0147_T' shot on 2023-08-01 at 13:23:21.
+FILENAME_PATTERN = re.compile(r'^(?P<crop>\d*)(?P<frame>DJI_(?P<timestamp>\d{14})_\d+(_[A-Z]+)?)', re.IGNORECASE)
+
+IMAGE_EXTENSIONS = ('.bmp', '.jpeg', '.jpg', '.png', '.tif', '.tiff')
+
+
+def parse_filename(filename: str) -> Tuple[str, Optional[datetime]]:
+    """Extracts the source DJI frame and its timestamp from an image filename.
+
+    Args:
+        filename: Path or name of the image (e.g., 'strings/defect/102DJI_20230801132321_0147_T.JPG').
+
+    Returns:
+        Source frame name (the filename without extension if it does not follow the DJI naming convention).
+        Timestamp of the frame (None if it cannot be parsed).
+
+    """
+    name = os.path.splitext(os.path.basename(filename))[0]
+    match = FILENAME_PATTERN.match(name)
+    if match is None:
+        return name, None
+
+    return match.group('frame'), datetime.strptime(match.group('timestamp'), '%Y%m%d%H%M%S')
+
+
+def file_hash(path: str) -> str:
+    """Computes the SHA-1 hash of the content of a file.
+
+    Args:
+        path: Path to the file.
+
+    Returns:
+        Hexadecimal digest.
+
+    """
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+
+    return digest.hexdigest()
+
+
+def list_directory(directory: str) -> pd.DataFrame:
+    """Lists the images of a folder with one subfolder per class.
+
+    Args:
+        directory: Relative path to the folder (e.g., 'strings/train').
+
+    Returns:
+        Dataframe with the image paths ('filename') and labels ('class').
+
+    """
+    rows = [(os.path.join(directory, label, name).replace('\\', '/'), label)
+            for label in sorted(os.listdir(directory)) if os.path.isdir(os.path.join(directory, label))
+            for name in sorted(os.listdir(os.path.join(directory, label))) if name.lower().endswith(IMAGE_EXTENSIONS)]
+
+    return pd.DataFrame(rows, columns=['filename', 'class'])
+
+
+class Dataset:
+    """Manifest of the images of a dataset stored in a SQLite index.
+
+    Every image is indexed once with its content hash, label, source frame and split, so duplicated copies can be
+    detected and the training/validation split can be changed without copying files.
+
+        Examples:
+            1. Indexing a folder with one subfolder per class and creating a split grouped by source frame.
+                dataset = Dataset('strings/manifest.sqlite')
+                dataset.index('strings')
+                dataset.split(validation_fraction=0.2, strategy='group')
+
+            2. Training and evaluating the CNN from the manifest.
+                cnn.train(dataset.dataframe('train'), dataset.dataframe('validation'), base_model='ResNet50')
+                cnn.predict(results_folder, dataset.dataframe('validation'))
+
+    """
+
+    def __init__(self, manifest: str):
+        """Dataset initializer. Creates the manifest if it does not exist.
+
+        Args:
+            manifest: Path to the SQLite manifest file.
+
+        """
+        self._connection = sqlite3.connect(manifest)
+        self._connection.execute(
+            'CREATE TABLE IF NOT EXISTS images ('
+            'path TEXT PRIMARY KEY, hash TEXT NOT NULL, size INTEGER, mtime REAL, label TEXT, frame TEXT, '
+            'timestamp TEXT, split TEXT)'
+        )
+        self._connection.execute('CREATE INDEX IF NOT EXISTS images_hash ON images (hash)')
+        self._connection.execute('CREATE INDEX IF NOT EXISTS images_split ON images (split)')
+        self._connection.commit()
+
+    def index(self, root_dir: str, labels: Tuple[str, ...] = ('defect', 'no-defect')) -> int:
+        """Adds every image under a folder to the manifest.
+
+        The label of an image is the name of the closest parent folder found in labels. Images whose size and
+        modification time have not changed since the last call are not read again. Images under the folder that no
+        longer exist (e.g., crops moved to another class folder) are removed from the manifest.
+
+        Args:
+            root_dir: Relative path to the folder to index (e.g., 'strings').
+            labels: Known class folder names.
+
+        Returns:
+            Number of images read and hashed.
+
+        """
+        known = {path: (size, mtime) for path, size, mtime in
+                 self._connection.execute('SELECT path, size, mtime FROM images')}
+        seen = set()
+        hashed = 0
+
+        for root, dirs, files in os.walk(root_dir):
+            dirs.sort()
+            parents = root.replace('\\', '/').split('/')
+            label = next((folder for folder in reversed(parents) if folder in labels), None)
+
+            for name in sorted(files):
+                if not name.lower().endswith(IMAGE_EXTENSIONS):
+                    continue
+
+                path = os.path.join(root, name).replace('\\', '/')
+                seen.add(path)
+                stat = os.stat(path)
+                if known.get(path) == (stat.st_size, stat.st_mtime):
+                    continue
+
+                frame, timestamp = parse_filename(name)
+                self._connection.execute(
+                    'INSERT OR REPLACE INTO images (path, hash, size, mtime, label, frame, timestamp, split) '
+                    'VALUES (?, ?, ?, ?, ?, ?, ?, (SELECT split FROM images WHERE path = ?))',
+                    (path, file_hash(path), stat.st_size, stat.st_mtime, label, frame,
+                     timestamp.isoformat() if timestamp else None, path)
+                )
+                hashed += 1
+
+        # Stale rows would keep the old label of a moved image and shadow the new path of its content
+        prefix = root_dir.replace('\\', '/').rstrip('/') + '/'
+        self._connection.executemany('DELETE FROM images WHERE path = ?',
+                                     [(path,) for path in known if path.startswith(prefix) and path not in seen])
+        self._connection.commit()
+
+        return hashed
+
+    def duplicates(self) -> List[List[str]]:
+        """Finds the images stored more than once.
+
+        Returns:
+            Groups of paths sharing the same content.
+
+        """
+        groups: Dict[str, List[str]] = {}
+        for content_hash, path in self._connection.execute(
+                'SELECT hash, path FROM images WHERE hash IN (SELECT hash FROM images GROUP BY hash HAVING COUNT(*) > 1) '
+                'ORDER BY hash, path'):
+            groups.setdefault(content_hash, []).append(path)
+
+        return list(groups.values())
+
+    def relabel(self, path: str, label: str):
+        """Changes the label of an image and of all its duplicates.
+
+        Args:
+            path: Path to the image as stored in the manifest.
+            label: New label.
+
+        """
+        self._connection.execute('UPDATE images SET label = ? WHERE hash = (SELECT hash FROM images WHERE path = ?)',
+                                 (label, path))
+        self._connection.commit()
+
+    def split(self, validation_fraction: float = 0.2, strategy: str = 'group', seed: int = 0):
+        """Assigns every unique labelled image to the 'train' or 'validation' split.
+
+        Only the first path of each group of duplicates is assigned to a split; the rest are left out so the same
+        content is never used twice.
+
+        Args:
+            validation_fraction: Fraction of the images of each class assigned to the validation split.
+            strategy: How images are distributed between splits.
+                - 'stratified': Images are drawn at random keeping the class proportions.
+                - 'group': Crops of the same source frame are kept together, keeping the class proportions.
+            seed: Random seed used to shuffle the images.
+
+        Raises:
+            ValueError: If the validation_fraction parameter is not between 0 and 1.
+            ValueError: If the strategy is not known.
+
+        """
+        if not 0 <= validation_fraction <= 1:
+            raise ValueError("validation_fraction must be between 0 and 1.")
+        if strategy not in ('stratified', 'group'):
+            raise ValueError("Split strategy not supported. Possible values are 'stratified' and 'group'.")
+
+        rows = self._connection.execute(
+            'SELECT MIN(path), label, frame FROM images WHERE label IS NOT NULL GROUP BY hash ORDER BY MIN(path)'
+        ).fetchall()
+
+        # Group the images (one image per group in the stratified strategy) and give each group its majority label
+        groups: Dict[str, List[Tuple[str, str]]] = {}
+        for path, label, frame in rows:
+            groups.setdefault(frame if strategy == 'group' else path, []).append((path, label))
+
+        groups_by_label: Dict[str, List[List[Tuple[str, str]]]] = {}
+        for members in groups.values():
+            labels = [label for path, label in members]
+            groups_by_label.setdefault(max(set(labels), key=labels.count), []).append(members)
+
+        # Fill the validation split class by class until the requested fraction is reached
+        generator = random.Random(seed)
+        assignment = []
+        for label in sorted(groups_by_label):
+            label_groups = groups_by_label[label]
+            generator.shuffle(label_groups)
+            target = validation_fraction * sum(len(members) for members in label_groups)
+            assigned = 0
+
+            for members in label_groups:
+                split = 'validation' if assigned < target else 'train'
+                if split == 'validation':
+                    assigned += len(members)
+                assignment.extend((split, path) for path, _ in members)
+
+        self._connection.execute('UPDATE images SET split = NULL')
+        self._connection.executemany('UPDATE images SET split = ? WHERE path = ?', assignment)
+        self._connection.commit()
+
+    def dataframe(self, split: Optional[str] = None) -> pd.DataFrame:
+        """Lists the labelled images of a split in the format expected by CNN.train and CNN.predict.
+
+        Args:
+            split: Split name ('train' or 'validation'). None to list every unique labelled image.
+
+        Returns:
+            Dataframe with the image paths ('filename') and labels ('class').
+
+        """
+        if split is None:
+            query = 'SELECT MIN(path), label FROM images WHERE label IS NOT NULL GROUP BY hash ORDER BY MIN(path)'
+            parameters = ()
+        else:
+            query = 'SELECT path, label FROM images WHERE split = ? AND label IS NOT NULL ORDER BY path'
+            parameters = (split,)
+
+        return pd.DataFrame(self._connection.execute(query, parameters).fetchall(), columns=['filename', 'class'])
+
+    def close(self):
+        """Closes the manifest."""
+        self._connection.close()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Index a dataset and manage its training/validation split.')
+    parser.add_argument('root_dir', help="Folder with one subfolder per class (e.g., 'strings').")
+    parser.add_argument('--manifest', default='manifest.sqlite', help='Path to the SQLite manifest.')
+    parser.add_argument('--validation-fraction', type=float, default=0.2)
+    parser.add_argument('--strategy', choices=('stratified', 'group'), default='group')
+    parser.add_argument('--seed', type=int, default=0)
+    arguments = parser.parse_args()
+
+    dataset = Dataset(arguments.manifest)
+    print('Indexed images:', dataset.index(arguments.root_dir))
+    print('Duplicated images:', sum(len(group) - 1 for group in dataset.duplicates()))
+    dataset.split(arguments.validation_fraction, arguments.strategy, arguments.seed)
+    for split in ('train', 'validation'):
+        print(split, dataset.dataframe(split)['class'].value_counts().to_dict())
+    dataset.close()
@@ -0,0 +1,218 @@
+import argparse
+import json
+import sqlite3
+import time
+import numpy as np
+import pandas as pd
+import tensorflow as tf
+from datetime import datetime
+from typing import Dict, Optional
+
+from dataset import file_hash
+
+
+class ExperimentStore:
+    """Local SQLite store of the training and prediction runs of the CNN class.
+
+    Every run records its hyperparameters, timing and throughput, the model file and its hash, and its results. Training
+    runs also record the metrics and duration of every epoch.
+
+        Examples:
+            1. Tracking the runs of a CNN.
+                cnn = CNN(experiment_store=ExperimentStore('experiments.sqlite'))
+                cnn.train(training_dir, validation_dir, base_model='ResNet50')
+                cnn.save(filename)
+                cnn.predict(results_folder, validation_dir)
+
+            2. Comparing the trade-off between validation AUC, training time and inference latency of the runs.
+                python experiments.py compare --db experiments.sqlite
+
+    """
+
+    def __init__(self, database: str = 'experiments.sqlite'):
+        """ExperimentStore initializer. Creates the database if it does not exist.
+
+        Args:
+            database: Path to the SQLite database.
+
+        """
+        self._connection = sqlite3.connect(database, check_same_thread=False)
+        self._connection.executescript(
+            'CREATE TABLE IF NOT EXISTS runs ('
+            'id INTEGER PRIMARY KEY AUTOINCREMENT, kind TEXT NOT NULL, started TEXT NOT NULL, parameters TEXT, '
+            'seconds REAL, images INTEGER, images_per_second REAL, accuracy REAL, auc REAL, model_path TEXT, '
+            'model_hash TEXT, results_path TEXT);'
+            'CREATE TABLE IF NOT EXISTS epochs ('
+            'run_id INTEGER NOT NULL REFERENCES runs (id), epoch INTEGER NOT NULL, seconds REAL, metrics TEXT, '
+            'PRIMARY KEY (run_id, epoch));'
+            'CREATE INDEX IF NOT EXISTS runs_model_hash ON runs (model_hash);'
+        )
+        self._connection.commit()
+
+    def start_run(self, kind: str, parameters: Dict, model_path: str = "", model_hash: str = "") -> int:
+        """Records the start of a run.
+
+        Args:
+            kind: 'train', 'fine_tune', 'update' or 'predict'.
+            parameters: Hyperparameters of the run.
+            model_path: Path to the model file used by the run, if any.
+            model_hash: Hash of the model file used by the run, if any.
+
+        Returns:
+            Run identifier.
+
+        """
+        cursor = self._connection.execute(
+            'INSERT INTO runs (kind, started, parameters, model_path, model_hash) VALUES (?, ?, ?, ?, ?)',
+            (kind, datetime.now().isoformat(timespec='seconds'), json.dumps(parameters, sort_keys=True, default=str),
+             model_path or None, model_hash or None)
+        )
+        self._connection.commit()
+
+        return cursor.lastrowid
+
+    def log_epoch(self, run_id: int, epoch: int, seconds: float, metrics: Dict[str, float]):
+        """Records the metrics of a training epoch.
+
+        Args:
+            run_id: Run identifier.
+            epoch: Epoch number (starting at 0).
+            seconds: Duration of the epoch.
+            metrics: Training and validation metrics.
+
+        """
+        self._connection.execute('INSERT OR REPLACE INTO epochs (run_id, epoch, seconds, metrics) VALUES (?, ?, ?, ?)',
+                                 (run_id, epoch, seconds, json.dumps({k: float(v) for k, v in metrics.items()})))
+        self._connection.commit()
+
+    def finish_run(self, run_id: int, seconds: float, images: int = 0, accuracy: Optional[float] = None,
+                   auc: Optional[float] = None, results_path: str = ""):
+        """Records the results of a run.
+
+        Args:
+            run_id: Run identifier.
+            seconds: Duration of the run.
+            images: Number of images processed (once per epoch for training runs).
+            accuracy: Classification accuracy (validation accuracy of the last epoch for training runs).
+            auc: Area under the ROC curve (validation AUC of the last epoch for training runs).
+            results_path: Path to the results file, if any.
+
+        """
+        self._connection.execute(
+            'UPDATE runs SET seconds = ?, images = ?, images_per_second = ?, accuracy = ?, auc = ?, results_path = ? '
+            'WHERE id = ?',
+            (seconds, images, images / seconds if seconds else None, accuracy, auc, results_path or None, run_id)
+        )
+        self._connection.commit()
+
+    def set_model(self, run_id: int, model_path: str):
+        """Records the model file written by a training run.
+
+        Args:
+            run_id: Run identifier.
+            model_path: Path to the model file.
+
+        """
+        self._connection.execute('UPDATE runs SET model_path = ?, model_hash = ? WHERE id = ?',
+                                 (model_path, file_hash(model_path), run_id))
+        self._connection.commit()
+
+    def callback(self, run_id: int) -> tf.keras.callbacks.Callback:
+        """Creates a Keras callback that records the metrics and duration of every epoch of a run.
+
+        Args:
+            run_id: Run identifier.
+
+        Returns:
+            Callback.
+
+        """
+        store = self
+
+        class EpochLogger(tf.keras.callbacks.Callback):
+
+            def on_epoch_begin(self, epoch, logs=None):
+                self._start = time.perf_counter()
+
+            def on_epoch_end(self, epoch, logs=None):
+                store.log_epoch(run_id, epoch, time.perf_counter() - self._start, logs or {})
+
+        return EpochLogger()
+
+    def runs(self, kind: Optional[str] = None) -> pd.DataFrame:
+        """Lists the recorded runs.
+
+        Args:
+            kind: 'train', 'fine_tune', 'update' or 'predict'. None for every run.
+
+        Returns:
+            One row per run, with one column per hyperparameter.
+
+        """
+        query, parameters = 'SELECT * FROM runs', ()
+        if kind:
+            query, parameters = query + ' WHERE kind = ?', (kind,)
+        runs_df = pd.read_sql_query(query + ' ORDER BY id', self._connection, params=parameters)
+
+        hyperparameters = pd.DataFrame([json.loads(value or '{}') for value in runs_df.pop('parameters')],
+                                       index=runs_df.index)
+        return pd.concat([runs_df, hyperparameters], axis=1)
+
+    def compare(self, kind: str = 'train') -> pd.DataFrame:
+        """Compares the training runs of a kind by validation AUC, training time and inference latency.
+
+        A run is on the Pareto front ('pareto' column) when no other run is at least as good on the three criteria and
+        better on one of them. Those runs are the actual trade-offs to choose from and they are listed first; within
+        each group, runs are sorted by validation AUC. Missing values count as the worst possible.
+
+        The inference latency of a training run is the best latency of the prediction runs of the model it saved.
+
+        Args:
+            kind: 'train', 'fine_tune' or 'update'. Runs of different kinds start from different models, so they are
+                  not compared with each other.
+
+        Returns:
+            One row per training run.
+
+        """
+        comparison = pd.read_sql_query(
+            'SELECT t.id, t.started, t.parameters, t.auc AS validation_auc, t.accuracy AS validation_accuracy, '
+            't.seconds AS training_seconds, t.model_path, 1000 / MAX(p.images_per_second) AS latency_ms '
+            'FROM runs t LEFT JOIN runs p ON p.kind = \'predict\' AND p.model_hash = t.model_hash '
+            'WHERE t.kind = ? GROUP BY t.id',
+            self._connection, params=(kind,)
+        )
+        hyperparameters = pd.DataFrame([json.loads(value or '{}') for value in comparison.pop('parameters')],
+                                       index=comparison.index)
+        comparison = pd.concat([comparison, hyperparameters], axis=1)
+
+        # Every criterion as a cost (lower is better)
+        costs = np.column_stack([
+            -comparison['validation_auc'].astype(float).fillna(-np.inf),
+            comparison['training_seconds'].astype(float).fillna(np.inf),
+            comparison['latency_ms'].astype(float).fillna(np.inf),
+        ])
+        no_worse = (costs[np.newaxis, :, :] <= costs[:, np.newaxis, :]).all(axis=2)
+        better = (costs[np.newaxis, :, :] < costs[:, np.newaxis, :]).any(axis=2)
+        comparison['pareto'] = ~(no_worse & better).any(axis=1)
+
+        return comparison.sort_values(['pareto', 'validation_auc', 'training_seconds', 'latency_ms'],
+                                      ascending=[False, False, True, True], na_position='last').reset_index(drop=True)
+
+    def close(self):
+        """Closes the database."""
+        self._connection.close()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Query the experiment store.')
+    parser.add_argument('command', choices=('compare', 'runs'))
+    parser.add_argument('--db', default='experiments.sqlite')
+    parser.add_argument('--kind', choices=('train', 'fine_tune', 'update', 'predict'))
+    arguments = parser.parse_args()
+
+    pd.set_option('display.max_columns', 30)
+    pd.set_option('display.width', 400)
+
+    store = ExperimentStore(arguments.db)
+    print(store.compare(arguments.kind or 'train') if arguments.command == 'compare' else store.runs(arguments.kind))
+    store.close()
@@ -0,0 +1,92 @@
+import argparse
+import os
+import matplotlib.cm as cm
+import numpy as np
+import pandas as pd
+from typing import List
+
+# cnn applies the oneDNN options of the host profile, which are read when TensorFlow is loaded
+from cnn import CNN
+
+import tensorflow as tf
+
+
+def read_predicted(results_file: str, predicted: str = 'defect') -> List[str]:
+    """Lists the images assigned to a class in a results file written by Results.
+
+    Args:
+        results_file: Path to a per image results CSV file or to an Excel results workbook.
+        predicted: Predicted class.
+
+    Returns:
+        Paths to the images.
+
+    """
+    if results_file.endswith('.xlsx'):
+        classification_df = pd.read_excel(results_file, sheet_name='Classification results')
+    else:
+        classification_df = pd.read_csv(results_file)
+
+    selection = classification_df[classification_df['Predicted'] == predicted]
+
+    return (selection['Folder_Path'] + selection['Image']).tolist()
+
+
+def save_heatmaps(cnn: CNN, images: List[str], output_dir: str, batch_size: int = 32, overlays: bool = True,
+                  alpha: float = 0.4) -> str:
+    """Computes the Grad-CAM maps of the defects of a set of images and saves them.
+
+    The maps of all the images are stored in a single compressed file at the resolution of the explained layer
+    (float16, about 100 bytes per image). Optionally, an overlay of each map on its image is saved as a JPEG file.
+
+    Args:
+        cnn: Trained CNN.
+        images: Paths to the images (e.g., the output of read_predicted).
+        output_dir: Path to the folder where the maps are stored.
+        batch_size: Number of images explained in one iteration.
+        overlays: Save an overlay image per image.
+        alpha: Opacity of the maps in the overlay images.
+
+    Returns:
+        Path to the file with the maps.
+
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    colormap = cm.jet
+
+    all_filenames, all_heatmaps = [], []
+    for filenames, probabilities, heatmaps in cnn.grad_cam(images, batch_size):
+        all_filenames.extend(filenames)
+        all_heatmaps.append(heatmaps.astype(np.float16))
+
+        if not overlays:
+            continue
+
+        for filename, heatmap in zip(filenames, heatmaps):
+            image = tf.keras.utils.img_to_array(tf.keras.utils.load_img(filename))
+            heatmap = tf.image.resize(heatmap[..., np.newaxis], image.shape[:2]).numpy()[..., 0]
+            overlay = (1 - alpha) * image + alpha * 255 * colormap(heatmap)[..., :3]
+            name = os.path.splitext(os.path.basename(filename))[0] + '_gradcam.jpg'
+            tf.keras.utils.save_img(os.path.join(output_dir, name), overlay, scale=False)
+
+    filename = os.path.join(output_dir, 'heatmaps.npz')
+    np.savez_compressed(filename, filenames=np.array(all_filenames),
+                        heatmaps=np.concatenate(all_heatmaps) if all_heatmaps else np.zeros((0, 0, 0), np.float16))
+
+    return filename
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Locate the defects of the images predicted as defective.')
+    parser.add_argument('model', help='Relative path to the model file without the extension.')
+    parser.add_argument('results_file', help='Per image results CSV file or Excel results workbook.')
+    parser.add_argument('--output-dir', default='', help='Defaults to a folder next to the results file.')
+    parser.add_argument('--batch-size', type=int, default=32)
+    parser.add_argument('--no-overlays', action='store_true')
+    arguments = parser.parse_args()
+
+    cnn = CNN()
+    cnn.load(arguments.model)
+    output_dir = arguments.output_dir or os.path.splitext(arguments.results_file)[0] + '_gradcam'
+    print(save_heatmaps(cnn, read_predicted(arguments.results_file), output_dir, arguments.batch_size,
+                        not arguments.no_overlays))
@@ -0,0 +1,222 @@
+import argparse
+import json
+import os
+import shutil
+import time
+import numpy as np
+from datetime import datetime
+from typing import Dict, List, Optional, Tuple
+
+from runtime import RuntimeProfile
+
+# oneDNN options are read when TensorFlow is loaded, so the profile of this host is applied before importing it
+RuntimeProfile.load().apply_environment()
+
+import tensorflow as tf
+
+from sampling import ClassRecall
+
+# Offsets of the weight arrays in weights.bin are aligned so every memory-mapped array starts on a cache line
+WEIGHTS_ALIGNMENT = 64
+
+
+class ModelRegistry:
+    """Local registry of versioned models.
+
+    Every version is stored in '<root>/<name>/<version>/' as a config.json file (Keras architecture, base model, target
+    size, channels, threshold, class indices, training metrics and the layout of the weights) and a flat weights.bin
+    file with every weight array at a known offset. Loading rebuilds the architecture from its configuration and copies
+    the weights in from the (optionally memory-mapped) file, without the HDF5 parsing and graph deserialization done by
+    tf.keras.models.load_model.
+
+        Examples:
+            1. Registering a trained CNN and loading its latest version.
+                registry = ModelRegistry('models')
+                version = cnn.save_version(registry, 'strings', threshold=0.5)
+                cnn = CNN()
+                cnn.load_version(registry, 'strings')
+
+            2. Comparing the load time of a version with the .h5 file of the same model.
+                python registry.py benchmark strings --h5 ResNet50_strings.h5
+
+    """
+
+    def __init__(self, root: str = 'models'):
+        """ModelRegistry initializer.
+
+        Args:
+            root: Folder where the models are stored.
+
+        """
+        self._root = root
+
+    def save(self, name: str, model: tf.keras.Model, metadata: Dict) -> int:
+        """Stores a new version of a model.
+
+        Args:
+            name: Model name.
+            model: Keras model.
+            metadata: Information stored along with the architecture (base model, target size, threshold...).
+
+        Returns:
+            Version number.
+
+        """
+        os.makedirs(os.path.join(self._root, name), exist_ok=True)
+        versions = self.versions(name)
+        version = versions[-1] + 1 if versions else 1
+
+        # Written to a temporary folder and renamed: an interrupted save never leaves a partial version
+        directory = os.path.join(self._root, name, str(version))
+        temporary = directory + '.tmp'
+        shutil.rmtree(temporary, ignore_errors=True)
+        os.makedirs(temporary)
+
+        layout, offset = [], 0
+        with open(os.path.join(temporary, 'weights.bin'), 'wb') as f:
+            for weights in model.get_weights():
+                weights = np.ascontiguousarray(weights)
+                padding = -offset % WEIGHTS_ALIGNMENT
+                f.write(b'\0' * padding)
+                offset += padding
+                layout.append({'offset': offset, 'shape': list(weights.shape), 'dtype': weights.dtype.str})
+                f.write(weights.tobytes())
+                offset += weights.nbytes
+
+        config = dict(metadata, name=name, version=version, created=datetime.now().isoformat(timespec='seconds'),
+                      architecture=json.loads(model.to_json()), weights=layout)
+        with open(os.path.join(temporary, 'config.json'), 'w', encoding='utf-8') as f:
+            json.dump(config, f, ensure_ascii=False, indent=4, sort_keys=True, default=str)
+
+        os.rename(temporary, directory)
+
+        return version
+
+    def load(self, name: str, version: Optional[int] = None, mmap: bool = True) -> Tuple[tf.keras.Model, Dict]:
+        """Loads a version of a model.
+
+        Args:
+            name: Model name.
+            version: Version number. None for the latest version.
+            mmap: Memory-map the weights file instead of reading it whole. Only the pages of each array are read, while
+                  it is copied into the model.
+
+        Returns:
+            Keras model.
+            Version configuration, without the architecture and the weights layout.
+
+        Raises:
+            ValueError: If the model has no versions.
+
+        """
+        config = self.config(name, version)
+        directory = os.path.join(self._root, name, str(config['version']))
+
+        model = tf.keras.models.model_from_json(json.dumps(config.pop('architecture')),
+                                                custom_objects={'ClassRecall': ClassRecall})
+
+        filename = os.path.join(directory, 'weights.bin')
+        if mmap:
+            buffer = np.memmap(filename, dtype=np.uint8, mode='r')
+        else:
+            buffer = np.fromfile(filename, dtype=np.uint8)
+        model.set_weights([np.frombuffer(buffer, dtype=layout['dtype'], count=int(np.prod(layout['shape'])),
+                                         offset=layout['offset']).reshape(layout['shape'])
+                           for layout in config.pop('weights')])
+
+        return model, config
+
+    def config(self, name: str, version: Optional[int] = None) -> Dict:
+        """Reads the configuration of a version of a model.
+
+        Args:
+            name: Model name.
+            version: Version number. None for the latest version.
+
+        Returns:
+            Version configuration.
+
+        Raises:
+            ValueError: If the model has no versions.
+
+        """
+        if version is None:
+            versions = self.versions(name)
+            if not versions:
+                raise ValueError("Model '{}' has no versions in {}.".format(name, self._root))
+            version = versions[-1]
+
+        with open(os.path.join(self._root, name, str(version), 'config.json'), encoding='utf-8') as f:
+            return json.load(f)
+
+    def models(self) -> List[str]:
+        """Lists the names of the registered models."""
+        if not os.path.isdir(self._root):
+            return []
+
+        return sorted(name for name in os.listdir(self._root) if self.versions(name))
+
+    def versions(self, name: str) -> List[int]:
+        """Lists the versions of a model, oldest first."""
+        directory = os.path.join(self._root, name)
+        if not os.path.isdir(directory):
+            return []
+
+        return sorted(int(version) for version in os.listdir(directory)
+                      if version.isdigit() and os.path.exists(os.path.join(directory, version, 'config.json')))
+
+    def benchmark(self, name: str, version: Optional[int] = None, h5_filename: str = "",
+                  repeats: int = 3) -> Dict[str, float]:
+        """Measures the load time of a version of a model, and of its .h5 file if given.
+
+        Args:
+            name: Model name.
+            version: Version number. None for the latest version.
+            h5_filename: Path to the .h5 file of the same model, loaded with tf.keras.models.load_model.
+            repeats: Number of loads timed. The best time is kept.
+
+        Returns:
+            Best load time in seconds of each method ('registry_mmap', 'registry_read' and 'h5').
+
+        """
+        loaders = {
+            'registry_mmap': lambda: self.load(name, version, mmap=True),
+            'registry_read': lambda: self.load(name, version, mmap=False),
+        }
+        if h5_filename:
+            loaders['h5'] = lambda: tf.keras.models.load_model(h5_filename, custom_objects={'ClassRecall': ClassRecall})
+
+        timings = {}
+        for method, loader in loaders.items():
+            elapsed = []
+            for _ in range(repeats):
+                tf.keras.backend.clear_session()
+                start = time.perf_counter()
+                loader()
+                elapsed.append(time.perf_counter() - start)
+            timings[method] = min(elapsed)
+
+        return timings
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Query the model registry.')
+    parser.add_argument('command', choices=('list', 'benchmark'))
+    parser.add_argument('name', nargs='?', default="")
+    parser.add_argument('--root', default='models')
+    parser.add_argument('--version', type=int)
+    parser.add_argument('--h5', default="", help='.h5 file of the same model to compare with (benchmark only).')
+    parser.add_argument('--repeats', type=int, default=3)
+    arguments = parser.parse_args()
+
+    registry = ModelRegistry(arguments.root)
+    if arguments.command == 'list':
+        for model_name in [arguments.name] if arguments.name else registry.models():
+            for model_version in registry.versions(model_name):
+                model_config = registry.config(model_name, model_version)
+                print(model_name, model_version, model_config['created'], model_config.get('base_model'),
+                      model_config.get('threshold'), json.dumps(model_config.get('metrics', {}), sort_keys=True))
+    else:
+        for method, seconds in registry.benchmark(arguments.name, arguments.version, arguments.h5,
+                                                  arguments.repeats).items():
+            print('{}: {:.3f} s'.format(method, seconds))
@@ -1,8 +1,12 @@
+import csv
 import numpy as np
 import os
 import pandas as pd
 from datetime import datetime
-from typing import Dict, List, Tuple
+from typing import Dict, List, Optional, Tuple
+
+# Number of probability bins used to compute the AUC in the streaming evaluation mode
+AUC_BINS = 1000
 
 
 class Results:
@@ -19,6 +23,15 @@ class Results:
         self._labels = labels
         self._dataset_name = dataset_name
 
+        # Running state used by the streaming evaluation mode
+        category_count = len(self._labels)
+        self._confusion_matrix = np.zeros((category_count, category_count))
+        self._histograms = np.zeros((category_count, AUC_BINS))
+        self._stream = None
+        self._stream_writer = None
+        self._stream_rows = []
+        self._chunk_size = 0
+
     def compute(self, test_dir: str,dataset: List[str], true_labels: List[int], predicted_labels: List[int]) -> \
             Tuple[float, np.ndarray, List[Tuple[str, str, str]]]:
         """Builds a confusion matrix and computes the classification accuracy.
@@ -52,6 +65,122 @@ class Results:
 
         return accuracy, confusion_matrix, classification
 
+    def update(self, true_labels: np.ndarray, predicted_labels: np.ndarray,
+               predictions: Optional[np.ndarray] = None) -> Tuple[float, np.ndarray]:
+        """Adds a batch of predictions to the running confusion matrix.
+
+        Only the confusion matrix and a histogram of the probabilities of each category are kept in memory, so the
+        cost of evaluating a test set does not depend on its size.
+
+        Args:
+            true_labels: Real categories of the batch.
+            predicted_labels: Predicted categories of the batch.
+            predictions: Probabilities of the second category for the batch, used by streaming_auc().
+
+        Returns:
+            Classification accuracy so far.
+            Confusion matrix so far.
+
+        """
+        np.add.at(self._confusion_matrix, (np.asarray(true_labels, dtype=int), np.asarray(predicted_labels, dtype=int)), 1)
+        if predictions is not None:
+            bins = np.minimum((np.ravel(predictions) * AUC_BINS).astype(int), AUC_BINS - 1)
+            np.add.at(self._histograms, (np.asarray(true_labels, dtype=int), bins), 1)
+        accuracy = np.trace(self._confusion_matrix) / max(np.sum(self._confusion_matrix), 1)
+
+        return accuracy, self._confusion_matrix
+
+    def open(self, results_folder: str, chunk_size: int = 10000) -> str:
+        """Opens a CSV file where the per image results are appended in chunks.
+
+        Args:
+            results_folder: Path where the results are going to be stored.
+            chunk_size: Number of rows kept in memory before they are written to disk.
+
+        Returns:
+            Path to the CSV file.
+
+        """
+        filename = self._filename(results_folder, "_results.csv")
+        self._chunk_size = chunk_size
+        self._stream = open(filename, 'w', newline='', encoding='utf-8')
+        self._stream_writer = csv.writer(self._stream)
+        self._stream_writer.writerow(('Image', 'Predicted', 'Folder_Path', 'probabilities'))
+
+        return filename
+
+    def write(self, test_dir: str, dataset: List[str], predicted_labels: List[int], predictions: np.ndarray):
+        """Appends a batch of per image results to the CSV file opened with open().
+
+        Args:
+            test_dir: Relative path to the test directory.
+            dataset: Paths to the test images of the batch.
+            predicted_labels: Predicted categories of the batch.
+            predictions: Probabilities returned by the model for the batch.
+
+        """
+        descriptions = {v: k for k, v in self._labels.items()}
+
+        for image, predicted, probability in zip(dataset, predicted_labels, np.ravel(predictions)):
+            absolute_path = os.path.join(test_dir, image)
+            folder_path = os.path.dirname(absolute_path).replace("\\", "/") + "/"
+            self._stream_rows.append((os.path.basename(image), descriptions[predicted], folder_path,
+                                      '%.2f' % (1 - probability)))
+
+        if len(self._stream_rows) >= self._chunk_size:
+            self._flush()
+
+    def close(self):
+        """Writes the remaining per image results and closes the CSV file."""
+        if self._stream is None:
+            return
+
+        self._flush()
+        self._stream.close()
+        self._stream = None
+        self._stream_writer = None
+
+    @staticmethod
+    def auc(true_labels: List[int], probabilities: np.ndarray) -> float:
+        """Computes the area under the ROC curve of the model output.
+
+        Args:
+            true_labels: Real categories (0 or 1).
+            probabilities: Probability of the second category for each image.
+
+        Returns:
+            Area under the ROC curve. NaN if only one category is present.
+
+        """
+        positives = np.asarray(true_labels) == 1
+        positive_count, negative_count = positives.sum(), (~positives).sum()
+        if positive_count == 0 or negative_count == 0:
+            return float('nan')
+
+        # Mann-Whitney U statistic, with tied probabilities sharing their average rank
+        ranks = pd.Series(np.ravel(probabilities)).rank().to_numpy()
+
+        return (ranks[positives].sum() - positive_count * (positive_count + 1) / 2) / (positive_count * negative_count)
+
+    def streaming_auc(self) -> float:
+        """Computes the area under the ROC curve of the probabilities added with update().
+
+        Probabilities are binned, so images falling in the same bin count as ties.
+
+        Returns:
+            Area under the ROC curve. NaN if only one category is present.
+
+        """
+        negatives, positives = self._histograms[0], self._histograms[1]
+        positive_count, negative_count = positives.sum(), negatives.sum()
+        if positive_count == 0 or negative_count == 0:
+            return float('nan')
+
+        # Negatives in lower bins rank below each positive; negatives in the same bin are counted as half
+        lower_negatives = np.cumsum(negatives) - negatives
+
+        return np.sum(positives * (lower_negatives + negatives / 2)) / (positive_count * negative_count)
+
     def print(self, accuracy: float, confusion_matrix: np.ndarray):
         """Prints a formatted confusion matrix in the console and the classification accuracy achieved.
 
@@ -80,7 +209,7 @@ class Results:
         print(confusion_df)
         print("\nAccuracy: ", accuracy)
 
-    def save(self, confusion_matrix: np.ndarray, classification: List[Tuple[str, str, str]], predictions: List[List[float]], results_folder: str):
+    def save(self, confusion_matrix: np.ndarray, classification: List[Tuple[str, str, str]], predictions: List[List[float]], results_folder: str) -> str:
         """Save results to an Excel file.
 
         Every argument is stored in its own sheet.
@@ -90,6 +219,9 @@ class Results:
             classification: Detailed per image classification results.
             predictions: Probabilities of every category for each image.
 
+        Returns:
+            Path to the Excel file.
+
         """
         # Format confusion matrix
         labels = [key for key, value in sorted(self._labels.items(), key=lambda x: x[1])]
@@ -103,10 +235,32 @@ class Results:
         classification_df = pd.concat([classification_df, probabilities_df], axis=1)
 
         # Write to Excel
-        workbook = results_folder + self._dataset_name.lower().replace(" ", "_") + '_' +str(datetime.now().today().date()).replace("-","_") + "_"+ datetime.now().time().strftime("%H%M%S")
-        workbook += "_results.xlsx"
+        workbook = self._filename(results_folder, "_results.xlsx")
 
         with pd.ExcelWriter(workbook) as writer:
             confusion_df.to_excel(writer, sheet_name='Confusion matrix', index_label='KNOWN/PREDICTED')
             classification_df.to_excel(writer, sheet_name='Classification results', index=False, float_format = '%.2f', freeze_panes=(1, 0))
-            
+
+        return workbook
+
+    def _flush(self):
+        """Writes the buffered per image results to the CSV file."""
+        self._stream_writer.writerows(self._stream_rows)
+        self._stream.flush()
+        self._stream_rows = []
+
+    def _filename(self, results_folder: str, suffix: str) -> str:
+        """Builds a timestamped results filename.
+
+        Args:
+            results_folder: Path where the results are going to be stored.
+            suffix: End of the filename, including the extension.
+
+        Returns:
+            Path to the results file.
+
+        """
+        filename = results_folder + self._dataset_name.lower().replace(" ", "_") + '_' +str(datetime.now().today().date()).replace("-","_") + "_"+ datetime.now().time().strftime("%H%M%S")
+        filename += suffix
+
+        return filename
@@ -0,0 +1,248 @@
+import argparse
+import itertools
+import json
+import os
+import socket
+import subprocess
+import sys
+from typing import List, Optional
+
+# NOTE: TensorFlow is imported lazily. oneDNN options are only read when TensorFlow is loaded, so the environment of a
+# profile has to be applied before the first import (see cnn.py).
+
+PROFILES_DIR = 'runtime_profiles'
+
+# Environment variables set by a profile
+ENVIRONMENT_VARIABLES = ('TF_ENABLE_ONEDNN_OPTS', 'OMP_NUM_THREADS')
+
+# JSON profile used instead of the saved profile of the host. Set for the benchmark processes of autotune().
+PROFILE_VARIABLE = 'RUNTIME_PROFILE'
+
+
+class RuntimeProfile:
+    """TensorFlow threading and oneDNN configuration of a host.
+
+        Examples:
+            1. Using a specific configuration.
+                cnn = CNN(RuntimeProfile(intra_op_threads=8, inter_op_threads=2, workers=4))
+
+            2. Benchmarking a few configurations and saving the fastest one as the profile of this host.
+                python runtime.py autotune ResNet50_70_0.01_0.3 --sample-dir strings/validation
+
+    """
+
+    def __init__(self, intra_op_threads: int = 0, inter_op_threads: int = 0, onednn: Optional[bool] = None,
+                 workers: int = 1):
+        """RuntimeProfile initializer.
+
+        Args:
+            intra_op_threads: Threads used to parallelize a single operation. 0 to let TensorFlow decide.
+            inter_op_threads: Threads used to run independent operations concurrently. 0 to let TensorFlow decide.
+            onednn: True/False to enable/disable oneDNN optimizations. None to keep the TensorFlow default.
+            workers: Number of threads loading and pre-processing images.
+
+        Raises:
+            ValueError: If a number of threads or workers is negative.
+
+        """
+        if min(intra_op_threads, inter_op_threads) < 0 or workers < 1:
+            raise ValueError("Threads must be positive integers (0 for the default) and workers must be at least 1.")
+
+        self.intra_op_threads = intra_op_threads
+        self.inter_op_threads = inter_op_threads
+        self.onednn = onednn
+        self.workers = workers
+
+    def __repr__(self) -> str:
+        return 'RuntimeProfile({})'.format(', '.join('{}={}'.format(k, v) for k, v in self.to_dict().items()))
+
+    def to_dict(self) -> dict:
+        """Converts the profile to a dictionary."""
+        return {
+            'intra_op_threads': self.intra_op_threads,
+            'inter_op_threads': self.inter_op_threads,
+            'onednn': self.onednn,
+            'workers': self.workers,
+        }
+
+    @classmethod
+    def load(cls, hostname: str = "", profiles_dir: str = PROFILES_DIR) -> 'RuntimeProfile':
+        """Loads the profile of a host.
+
+        Args:
+            hostname: Host name. Empty for the current host.
+            profiles_dir: Folder storing one profile per host.
+
+        Returns:
+            Saved profile, or the default configuration if the host has no profile. For the current host, the profile
+            in the RUNTIME_PROFILE environment variable takes precedence.
+
+        """
+        if not hostname and os.environ.get(PROFILE_VARIABLE):
+            return cls(**json.loads(os.environ[PROFILE_VARIABLE]))
+
+        filename = cls._filename(hostname, profiles_dir)
+        if not os.path.exists(filename):
+            return cls()
+
+        with open(filename, encoding='utf-8') as f:
+            return cls(**json.load(f))
+
+    def save(self, hostname: str = "", profiles_dir: str = PROFILES_DIR) -> str:
+        """Saves the profile of a host.
+
+        Args:
+            hostname: Host name. Empty for the current host.
+            profiles_dir: Folder storing one profile per host.
+
+        Returns:
+            Path to the profile file.
+
+        """
+        os.makedirs(profiles_dir, exist_ok=True)
+        filename = self._filename(hostname, profiles_dir)
+        with open(filename, 'w', encoding='utf-8') as f:
+            json.dump(self.to_dict(), f, ensure_ascii=False, indent=4, sort_keys=True)
+
+        return filename
+
+    def environment(self) -> dict:
+        """Environment variables read by TensorFlow when it is loaded, as set by the profile."""
+        variables = {}
+        if self.onednn is not None:
+            variables['TF_ENABLE_ONEDNN_OPTS'] = '1' if self.onednn else '0'
+        if self.intra_op_threads:
+            # oneDNN kernels run on the OpenMP thread pool rather than on the TensorFlow one
+            variables['OMP_NUM_THREADS'] = str(self.intra_op_threads)
+
+        return variables
+
+    def apply_environment(self):
+        """Sets the environment variables read by TensorFlow when it is loaded.
+
+        Variables already set in the environment are kept.
+
+        """
+        for name, value in self.environment().items():
+            os.environ.setdefault(name, value)
+
+    def apply(self):
+        """Configures the TensorFlow thread pools.
+
+        Raises:
+            RuntimeError: If TensorFlow has already been initialized with a different number of threads.
+
+        """
+        self.apply_environment()
+
+        import tensorflow as tf
+
+        if self.intra_op_threads:
+            tf.config.threading.set_intra_op_parallelism_threads(self.intra_op_threads)
+        if self.inter_op_threads:
+            tf.config.threading.set_inter_op_parallelism_threads(self.inter_op_threads)
+
+    @staticmethod
+    def _filename(hostname: str, profiles_dir: str) -> str:
+        """Builds the path to the profile file of a host."""
+        return os.path.join(profiles_dir, (hostname or socket.gethostname()) + '.json')
+
+
+def benchmark(model_filename: str, sample_dir: str, profile: RuntimeProfile, batch_size: int = 32,
+              steps: int = 4) -> float:
+    """Measures the inference throughput of a profile.
+
+    Every measurement runs in a new process because TensorFlow thread pools cannot be changed once initialized. The
+    process only gets the environment variables of the profile, not those of this process or of the saved profile of
+    the host, so every profile is measured as configured.
+
+    Args:
+        model_filename: Relative path to the model file without the extension.
+        sample_dir: Relative path to a folder with one subfolder per class (e.g., 'strings/validation').
+        profile: Configuration to benchmark.
+        batch_size: Number of images evaluated in one iteration.
+        steps: Number of batches measured.
+
+    Returns:
+        Images per second.
+
+    Raises:
+        RuntimeError: If the benchmark process fails (e.g., the sample has fewer images than a batch).
+
+    """
+    command = [sys.executable, os.path.abspath(__file__), 'benchmark', model_filename, '--sample-dir', sample_dir,
+               '--batch-size', str(batch_size), '--steps', str(steps), '--profile', json.dumps(profile.to_dict())]
+    environment = {name: value for name, value in os.environ.items() if name not in ENVIRONMENT_VARIABLES}
+    environment.update(profile.environment())
+    environment[PROFILE_VARIABLE] = json.dumps(profile.to_dict())
+
+    try:
+        output = subprocess.run(command, check=True, capture_output=True, text=True, env=environment).stdout
+    except subprocess.CalledProcessError as error:
+        message = (error.stderr.strip().splitlines() or ['exit code {}'.format(error.returncode)])[-1]
+        raise RuntimeError("Benchmark of {} failed: {}".format(profile, message)) from error
+
+    return float(output.strip().splitlines()[-1])
+
+
+def autotune(model_filename: str, sample_dir: str, candidates: Optional[List[RuntimeProfile]] = None,
+             batch_size: int = 32, steps: int = 4) -> RuntimeProfile:
+    """Benchmarks a few configurations and saves the fastest one as the profile of the current host.
+
+    Args:
+        model_filename: Relative path to the model file without the extension.
+        sample_dir: Relative path to a folder with one subfolder per class (e.g., 'strings/validation').
+        candidates: Configurations to benchmark. None to try a few combinations based on the number of cores.
+        batch_size: Number of images evaluated in one iteration.
+        steps: Number of batches measured per configuration.
+
+    Returns:
+        Fastest configuration.
+
+    Raises:
+        RuntimeError: If no configuration could be measured.
+
+    """
+    if candidates is None:
+        cores = os.cpu_count() or 1
+        candidates = [RuntimeProfile(intra_op_threads=intra, inter_op_threads=inter, onednn=onednn,
+                                     workers=min(4, cores))
+                      for intra, inter, onednn in itertools.product(sorted({cores, max(1, cores // 2)}), (1, 2),
+                                                                    (True, False))]
+
+    best_profile, best_throughput = None, 0.0
+    for profile in candidates:
+        throughput = benchmark(model_filename, sample_dir, profile, batch_size, steps)
+        print(profile, '{:.1f} images/s'.format(throughput))
+        if throughput > best_throughput:
+            best_profile, best_throughput = profile, throughput
+
+    if best_profile is None:
+        raise RuntimeError("No configuration processed any image of {}.".format(sample_dir))
+
+    print('\nFastest:', best_profile, '->', best_profile.save())
+
+    return best_profile
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Tune the TensorFlow runtime configuration of this host.')
+    parser.add_argument('command', choices=('autotune', 'benchmark'))
+    parser.add_argument('model', help='Relative path to the model file without the extension.')
+    parser.add_argument('--sample-dir', default='strings/validation')
+    parser.add_argument('--batch-size', type=int, default=32)
+    parser.add_argument('--steps', type=int, default=4)
+    parser.add_argument('--profile', help='JSON profile to benchmark (benchmark command only).')
+    arguments = parser.parse_args()
+
+    if arguments.command == 'autotune':
+        autotune(arguments.model, arguments.sample_dir, batch_size=arguments.batch_size, steps=arguments.steps)
+    else:
+        profile = RuntimeProfile(**json.loads(arguments.profile)) if arguments.profile else RuntimeProfile.load()
+        profile.apply_environment()
+
+        from cnn import CNN
+
+        cnn = CNN(profile)
+        cnn.load(arguments.model)
+        print(cnn.benchmark(arguments.sample_dir, arguments.batch_size, arguments.steps))
@@ -0,0 +1,132 @@
+import numpy as np
+import tensorflow as tf
+from typing import List, Optional
+
+
+class BalancedSequence(tf.keras.utils.Sequence):
+    """Sequence drawing class-balanced training batches from an image iterator.
+
+    The sampling only uses the labels the iterator already holds in memory (its classes attribute), so no file is
+    duplicated and the dataset is not read again. Images of the minority class are drawn more often and, since every
+    draw is augmented again by the iterator, the repeated images are different augmented versions.
+
+        Example:
+            training_generator = BalancedSequence(training_generator, strategy='stratified', seed=0)
+
+    """
+
+    def __init__(self, generator, strategy: str = 'weighted', seed: Optional[int] = None):
+        """BalancedSequence initializer.
+
+        Args:
+            generator: Training data iterator (e.g., returned by flow_from_directory).
+            strategy: How the batches are balanced.
+                - 'weighted': Every image is drawn with a probability inversely proportional to the size of its class.
+                - 'stratified': Every batch has the same number of images of each class.
+            seed: Random seed of the sampling.
+
+        Raises:
+            ValueError: If the strategy is not known.
+
+        """
+        if strategy not in ('weighted', 'stratified'):
+            raise ValueError("Sampling strategy not supported. Possible values are 'weighted' and 'stratified'.")
+
+        self._generator = generator
+        self._strategy = strategy
+        self._random = np.random.default_rng(seed)
+        self._batch_size = generator.batch_size
+
+        # In-memory label index: positions of the images of each class
+        classes = np.asarray(generator.classes)
+        self._class_positions = [np.flatnonzero(classes == label) for label in np.unique(classes)]
+        self._class_orders = [self._random.permutation(positions) for positions in self._class_positions]
+        self._class_pointers = [0] * len(self._class_positions)
+
+        self.filenames = generator.filenames
+        self.classes = generator.classes
+        self.class_indices = generator.class_indices
+        self.num_classes = generator.num_classes
+        # Every batch is full, so an epoch yields more samples than there are images unless they fill the last batch
+        self.samples = len(self) * self._batch_size
+
+        self._batches: List[np.ndarray] = []
+        self.on_epoch_end()
+
+    def __len__(self) -> int:
+        return len(self._generator)
+
+    def __getitem__(self, index: int):
+        return self._generator._get_batches_of_transformed_samples(self._batches[index])
+
+    def on_epoch_end(self):
+        class_count = len(self._class_positions)
+        self._batches = []
+
+        for _ in range(len(self)):
+            if self._strategy == 'weighted':
+                # Choosing the class uniformly gives every image a probability inversely proportional to its class size
+                counts = np.bincount(self._random.integers(class_count, size=self._batch_size), minlength=class_count)
+            else:
+                counts = np.full(class_count, self._batch_size // class_count)
+                counts[self._random.choice(class_count, self._batch_size % class_count, replace=False)] += 1
+
+            batch = np.concatenate([self._draw(label, count) for label, count in enumerate(counts)])
+            self._batches.append(self._random.permutation(batch))
+
+    def _draw(self, label: int, count: int) -> np.ndarray:
+        """Draws images of a class, going through all of them in random order before repeating any.
+
+        Args:
+            label: Class position.
+            count: Number of images drawn.
+
+        Returns:
+            Positions of the images in the iterator.
+
+        """
+        drawn = []
+        for _ in range(count):
+            if self._class_pointers[label] == len(self._class_orders[label]):
+                self._class_orders[label] = self._random.permutation(self._class_positions[label])
+                self._class_pointers[label] = 0
+            drawn.append(self._class_orders[label][self._class_pointers[label]])
+            self._class_pointers[label] += 1
+
+        return np.array(drawn, dtype=int)
+
+
+class ClassRecall(tf.keras.metrics.Metric):
+    """Recall of one class of a binary classifier with a single sigmoid output."""
+
+    def __init__(self, class_id: int, threshold: float = 0.5, name: Optional[str] = None, **kwargs):
+        """ClassRecall initializer.
+
+        Args:
+            class_id: Class whose recall is computed (0 or 1).
+            threshold: Minimum output to predict the class 1.
+            name: Metric name. Defaults to 'recall_<class_id>'.
+
+        """
+        super().__init__(name=name or 'recall_{}'.format(class_id), **kwargs)
+        self._class_id = class_id
+        self._threshold = threshold
+        self.true_positives = self.add_weight(name='true_positives', initializer='zeros')
+        self.positives = self.add_weight(name='positives', initializer='zeros')
+
+    def update_state(self, y_true, y_pred, sample_weight=None):
+        actual = tf.equal(tf.reshape(tf.cast(y_true, tf.int32), [-1]), self._class_id)
+        predicted = tf.equal(tf.reshape(tf.cast(y_pred >= self._threshold, tf.int32), [-1]), self._class_id)
+
+        self.true_positives.assign_add(tf.reduce_sum(tf.cast(actual & predicted, tf.float32)))
+        self.positives.assign_add(tf.reduce_sum(tf.cast(actual, tf.float32)))
+
+    def result(self):
+        return tf.math.divide_no_nan(self.true_positives, self.positives)
+
+    def reset_state(self):
+        self.true_positives.assign(0.0)
+        self.positives.assign(0.0)
+
+    def get_config(self):
+        return dict(super().get_config(), class_id=self._class_id, threshold=self._threshold)
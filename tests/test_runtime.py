@@ -0,0 +1,37 @@
+import subprocess
+
+import runtime
+from runtime import RuntimeProfile
+
+
+def test_benchmark_environment_overrides_parent(monkeypatch):
+    monkeypatch.setenv('TF_ENABLE_ONEDNN_OPTS', '1')
+    monkeypatch.setenv('OMP_NUM_THREADS', '64')
+    environments = []
+
+    def run(command, env=None, **kwargs):
+        environments.append(env)
+        return subprocess.CompletedProcess(command, 0, stdout='100.0\n')
+
+    monkeypatch.setattr(runtime.subprocess, 'run', run)
+
+    profile = RuntimeProfile(intra_op_threads=2, onednn=False)
+    assert runtime.benchmark('model', 'strings/validation', profile) == 100.0
+    assert environments[0]['TF_ENABLE_ONEDNN_OPTS'] == '0'
+    assert environments[0]['OMP_NUM_THREADS'] == '2'
+
+    runtime.benchmark('model', 'strings/validation', RuntimeProfile())
+    assert 'TF_ENABLE_ONEDNN_OPTS' not in environments[1]
+    assert 'OMP_NUM_THREADS' not in environments[1]
+
+    # The benchmark process uses the candidate instead of the saved profile of the host
+    monkeypatch.setenv(runtime.PROFILE_VARIABLE, environments[0][runtime.PROFILE_VARIABLE])
+    assert RuntimeProfile.load().to_dict() == profile.to_dict()
+
+
+def test_load_without_profile_variable(monkeypatch, tmp_path):
+    monkeypatch.delenv(runtime.PROFILE_VARIABLE, raising=False)
+    assert RuntimeProfile.load(profiles_dir=str(tmp_path)).to_dict() == RuntimeProfile().to_dict()
+
+    RuntimeProfile(workers=3).save(profiles_dir=str(tmp_path))
+    assert RuntimeProfile.load(profiles_dir=str(tmp_path)).workers == 3
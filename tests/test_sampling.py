@@ -0,0 +1,63 @@
+import numpy as np
+import pytest
+
+tf = pytest.importorskip('tensorflow')
+
+from augmentation import AugmentationCache  # noqa: E402
+from sampling import BalancedSequence  # noqa: E402
+
+
+class SyntheticIterator(tf.keras.utils.Sequence):
+    """Iterator with the attributes of the Keras image iterators, over tiny images labelled by their position."""
+
+    def __init__(self, image_count: int, defect_count: int, batch_size: int):
+        self.batch_size = batch_size
+        self.filenames = ['image_{}.JPG'.format(i) for i in range(image_count)]
+        self.classes = np.array([0] * defect_count + [1] * (image_count - defect_count))
+        self.class_indices = {'defect': 0, 'no-defect': 1}
+        self.num_classes = 2
+        self.samples = image_count
+
+    def __len__(self) -> int:
+        return -(-self.samples // self.batch_size)
+
+    def __getitem__(self, index: int):
+        return self._get_batches_of_transformed_samples(np.arange(index * self.batch_size,
+                                                                  min((index + 1) * self.batch_size, self.samples)))
+
+    def _get_batches_of_transformed_samples(self, index_array: np.ndarray):
+        images = np.repeat(index_array.astype(np.float32), 4 * 4 * 3).reshape(-1, 4, 4, 3)
+        return images, self.classes[index_array].astype(np.float32)
+
+
+@pytest.mark.parametrize('strategy', ['weighted', 'stratified'])
+def test_balanced_sequence_yields_full_batches(strategy):
+    sequence = BalancedSequence(SyntheticIterator(158, 20, 16), strategy, seed=0)
+
+    batch_lengths = [len(sequence[i][0]) for i in range(len(sequence))]
+    assert batch_lengths == [16] * 10
+    assert sequence.samples == sum(batch_lengths)
+
+
+def test_stratified_batches_are_balanced():
+    sequence = BalancedSequence(SyntheticIterator(158, 20, 16), 'stratified', seed=0)
+
+    for i in range(len(sequence)):
+        assert (sequence[i][1] == 0).sum() == 8
+
+
+@pytest.mark.parametrize('batch_size', [16, 32])
+def test_cached_balanced_sequence(tmp_path, batch_size):
+    sequence = BalancedSequence(SyntheticIterator(158, 20, batch_size), 'stratified', seed=0)
+    cached = AugmentationCache(str(tmp_path)).sequence(sequence, epochs=2, key={'seed': 0})
+
+    assert len(cached) == len(sequence)
+    assert cached.samples == sequence.samples
+    for epoch in range(2):
+        for i in range(len(cached)):
+            images, labels = cached[i]
+            assert len(images) == len(labels) == batch_size
+            # Labels still match the images they were drawn with
+            positions = images[:, 0, 0, 0].astype(int)
+            assert np.array_equal(labels, sequence.classes[positions])
+        cached.on_epoch_end()
@@ -0,0 +1,102 @@
+import tracemalloc
+import numpy as np
+import pytest
+
+from results import Results
+
+LABELS = {'defect': 0, 'no-defect': 1}
+
+
+def peak_memory(function, *args) -> int:
+    """Returns the peak memory traced while running a function."""
+    tracemalloc.start()
+    try:
+        function(*args)
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def stream_results(folder, image_count: int, batch_size: int = 32):
+    """Feeds a synthetic stream of predictions through the streaming evaluation of Results."""
+    random = np.random.default_rng(0)
+    results = Results(LABELS)
+    results.open(str(folder), chunk_size=1000)
+
+    for start in range(0, image_count, batch_size):
+        size = min(batch_size, image_count - start)
+        true_labels = random.integers(0, 2, size)
+        predictions = random.random(size).astype(np.float32)
+        predicted_labels = (predictions >= 0.5).astype(int)
+
+        results.update(true_labels, predicted_labels, predictions)
+        results.write('strings/test', ['defect/image_{}.JPG'.format(i) for i in range(start, start + size)],
+                      predicted_labels, predictions)
+
+    results.close()
+    assert results.streaming_auc() == pytest.approx(0.5, abs=0.05)
+
+
+def test_results_memory_does_not_grow(tmp_path):
+    (tmp_path / 'small').mkdir()
+    (tmp_path / 'large').mkdir()
+
+    small = peak_memory(stream_results, tmp_path / 'small', 10000)
+    large = peak_memory(stream_results, tmp_path / 'large', 100000)
+
+    assert large < 1.5 * small
+
+
+def test_predict_streaming_memory_does_not_grow(tmp_path, monkeypatch):
+    tf = pytest.importorskip('tensorflow')
+    from cnn import CNN
+
+    class Filenames:
+        """Image paths generated on demand, so the synthetic iterator itself does not grow with the image count."""
+
+        def __init__(self, image_count: int):
+            self._image_count = image_count
+
+        def __len__(self) -> int:
+            return self._image_count
+
+        def __getitem__(self, index: slice):
+            return ['defect/image_{}.JPG'.format(i) for i in range(*index.indices(self._image_count))]
+
+    class SyntheticSequence(tf.keras.utils.Sequence):
+
+        def __init__(self, image_count: int, batch_size: int):
+            self.batch_size = batch_size
+            self.filenames = Filenames(image_count)
+            self.class_indices = LABELS
+
+        def __len__(self) -> int:
+            return -(-len(self.filenames) // self.batch_size)
+
+        def __getitem__(self, index: int):
+            size = min(self.batch_size, len(self.filenames) - index * self.batch_size)
+            return np.zeros((size, 8, 8, 3), dtype=np.float32), np.arange(size) % 2
+
+    class StubModel:
+
+        @staticmethod
+        def predict_on_batch(x):
+            return np.full((len(x), 1), 0.7, dtype=np.float32)
+
+    def predict(image_count: int, folder):
+        cnn = CNN()
+        cnn._model = StubModel()
+        cnn._target_size = (8, 8)
+        monkeypatch.setattr(cnn, '_flow', lambda datagen, source, **kwargs: SyntheticSequence(image_count,
+                                                                                             kwargs['batch_size']))
+        images = cnn._predict_streaming(str(folder), 'strings/test', "", True, 0.5, 32, 1000)[0]
+        assert images == image_count
+
+    (tmp_path / 'small').mkdir()
+    (tmp_path / 'large').mkdir()
+    predict(320, tmp_path / 'small')  # Warm-up: TensorFlow allocates its own state on first use
+
+    small = peak_memory(predict, 3200, tmp_path / 'small')
+    large = peak_memory(predict, 32000, tmp_path / 'large')
+
+    assert large < 1.5 * small
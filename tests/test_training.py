@@ -0,0 +1,30 @@
+import numpy as np
+import pytest
+
+tf = pytest.importorskip('tensorflow')
+
+from cnn import CNN  # noqa: E402
+
+
+def test_set_seed_defaults():
+    cnn = CNN()
+    cnn._set_seed(None, False)
+
+    assert cnn._seed is None
+    assert not cnn._deterministic
+
+
+def test_set_seed_replaces_previous_training():
+    cnn = CNN()
+    cnn._set_seed(0, False)
+    first = np.random.rand()
+    cnn._set_seed(0, False)
+    assert np.random.rand() == first
+
+    cnn._set_seed(None, False)
+    assert cnn._seed is None
+
+
+def test_deterministic_requires_seed():
+    with pytest.raises(ValueError):
+        CNN()._set_seed(None, True)
@@ -0,0 +1,187 @@
+import math
+import os
+import struct
+import numpy as np
+import pandas as pd
+import tensorflow as tf
+from typing import Optional, Tuple
+
+# DJI radiometric JPEGs (R-JPEG) store the raw 16-bit sensor values of the thermal frame in the APP3 segments
+JPEG_APP3 = 0xE3
+JPEG_SOF_MARKERS = (0xC0, 0xC1, 0xC2)
+JPEG_SOS = 0xDA
+
+SIDECAR_EXTENSIONS = ('.npy', '.tiff', '.tif')
+
+
+def read_temperature(filename: str) -> np.ndarray:
+    """Reads the single-channel radiometric frame of a thermograph.
+
+    The frame is read from the first sidecar file found next to the image with the same name ('.npy', '.tiff' or
+    '.tif', e.g., extracted with the DJI Thermal SDK) or, if there is none, from the raw sensor values embedded in the
+    radiometric JPEG itself. Raw values are proportional to the temperature rather than calibrated in degrees, which is
+    irrelevant once every frame is normalized (see normalize_frame).
+
+    Args:
+        filename: Path to the thermograph (e.g., 'strings/defect/102DJI_20230801132321_0147_T.JPG').
+
+    Returns:
+        Frame with shape (height, width), as float32.
+
+    Raises:
+        ValueError: If the image has no sidecar and no radiometric data.
+
+    """
+    stem = os.path.splitext(filename)[0]
+    for extension in SIDECAR_EXTENSIONS:
+        if os.path.exists(stem + extension):
+            if extension == '.npy':
+                return np.load(stem + extension).astype(np.float32)
+
+            from PIL import Image
+            with Image.open(stem + extension) as image:
+                return np.asarray(image, dtype=np.float32)
+
+    return parse_radiometric_jpeg(filename).astype(np.float32)
+
+
+def parse_radiometric_jpeg(filename: str) -> np.ndarray:
+    """Extracts the raw sensor values embedded in the APP3 segments of a DJI radiometric JPEG.
+
+    Only the JPEG headers are read; the compressed pseudo-colour image is not decoded.
+
+    Args:
+        filename: Path to the radiometric JPEG.
+
+    Returns:
+        Raw frame with shape (height, width), as uint16.
+
+    Raises:
+        ValueError: If the file is not a JPEG or it has no radiometric data of the size of the image.
+
+    """
+    payload, size = bytearray(), None
+    with open(filename, 'rb') as f:
+        if f.read(2) != b'\xff\xd8':
+            raise ValueError("{} is not a JPEG file.".format(filename))
+
+        while True:
+            marker = f.read(2)
+            if len(marker) < 2 or marker[0] != 0xFF or marker[1] == JPEG_SOS:
+                break
+
+            length = struct.unpack('>H', f.read(2))[0]
+            segment = f.read(length - 2)
+            if marker[1] == JPEG_APP3:
+                payload += segment
+            elif marker[1] in JPEG_SOF_MARKERS:
+                size = struct.unpack('>HH', segment[1:5])
+
+    if size is None or len(payload) < 2 * size[0] * size[1]:
+        raise ValueError("{} has no radiometric data. Extract it to a .npy or .tiff sidecar file.".format(filename))
+
+    return np.frombuffer(bytes(payload[:2 * size[0] * size[1]]), dtype='<u2').reshape(size)
+
+
+def normalize_frame(frame: np.ndarray) -> np.ndarray:
+    """Standardizes a frame to zero mean and unit variance.
+
+    Normalizing each frame on its own removes the differences of ambient temperature and irradiance between flights,
+    so hotspots stand out relative to the rest of the string.
+
+    Args:
+        frame: Frame with shape (height, width, 1).
+
+    Returns:
+        Normalized frame.
+
+    """
+    return (frame - frame.mean()) / (frame.std() + 1e-6)
+
+
+class ThermalSequence(tf.keras.utils.Sequence):
+    """Iterator over batches of single-channel radiometric frames.
+
+    It mimics the iterators returned by flow_from_directory/flow_from_dataframe (filenames, classes, class_indices,
+    num_classes and samples attributes), so it can be used wherever the CNN class uses them.
+
+    """
+
+    def __init__(self, datagen: tf.keras.preprocessing.image.ImageDataGenerator, dataframe: pd.DataFrame,
+                 target_size: Tuple[int, int], batch_size: int = 32, class_mode: Optional[str] = 'binary',
+                 shuffle: bool = True, seed: Optional[int] = None):
+        """ThermalSequence initializer.
+
+        Args:
+            datagen: Data generator with the pre-processing/data augmentation functions applied to every frame.
+            dataframe: Image paths ('filename') and labels ('class'; not needed if class_mode is None).
+            target_size: Size the frames are resized to.
+            batch_size: Number of frames per batch.
+            class_mode: 'binary' to return labels along with the frames; None to return frames only.
+            shuffle: Shuffle the frames at the end of every epoch.
+            seed: Random seed used to shuffle the frames.
+
+        """
+        self._datagen = datagen
+        self._target_size = target_size
+        self.batch_size = batch_size
+        self._class_mode = class_mode
+        self._shuffle = shuffle
+        self._generator = np.random.default_rng(seed)
+
+        self.filenames = dataframe['filename'].tolist()
+        if class_mode is None:
+            self.class_indices = {}
+            self.classes = np.zeros(len(self.filenames), dtype=int)
+        else:
+            self.class_indices = {label: index for index, label in enumerate(sorted(dataframe['class'].unique()))}
+            self.classes = dataframe['class'].map(self.class_indices).to_numpy()
+        self.num_classes = len(self.class_indices)
+        self.samples = len(self.filenames)
+
+        self._order = np.arange(len(self.filenames))
+        self.on_epoch_end()
+
+    def __len__(self) -> int:
+        return math.ceil(len(self.filenames) / self.batch_size)
+
+    def __getitem__(self, index: int):
+        return self._get_batches_of_transformed_samples(self._order[index * self.batch_size:
+                                                                    (index + 1) * self.batch_size])
+
+    def on_epoch_end(self):
+        if self._shuffle:
+            self._generator.shuffle(self._order)
+
+    def _get_batches_of_transformed_samples(self, index_array: np.ndarray):
+        """Builds a batch from the frames at the given positions, like the Keras image iterators.
+
+        Args:
+            index_array: Positions of the frames in filenames.
+
+        Returns:
+            Frames, and labels unless class_mode is None.
+
+        """
+        frames = np.stack([self._load(self.filenames[i]) for i in index_array])
+
+        if self._class_mode is None:
+            return frames
+
+        return frames, self.classes[index_array].astype(np.float32)
+
+    def _load(self, filename: str) -> np.ndarray:
+        """Reads, resizes, augments and pre-processes a frame.
+
+        Args:
+            filename: Path to the thermograph.
+
+        Returns:
+            Frame with shape target_size + (1,).
+
+        """
+        frame = read_temperature(filename)[..., np.newaxis]
+        frame = tf.image.resize(frame, self._target_size).numpy()
+        frame = self._datagen.random_transform(frame)
+
+        return self._datagen.standardize(frame)
@@ -0,0 +1,321 @@
+import argparse
+import glob
+import hashlib
+import html
+import json
+import os
+import sqlite3
+import pandas as pd
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import parse_qs, urlencode, urlparse
+
+from dataset import parse_filename
+
+# Probability bands offered by the viewer filters (probability of the 'defect' class)
+PROBABILITY_BANDS = ((0.0, 0.1), (0.1, 0.3), (0.3, 0.5), (0.5, 0.7), (0.7, 0.9), (0.9, 1.0))
+
+
+class PredictionStore:
+    """Indexed SQLite store of the per image results written by Results (Excel workbooks or streaming CSV files).
+
+        Example:
+            store = PredictionStore('predictions.sqlite')
+            store.import_batch('batch_results')
+            rows, total = store.query(predicted='defect', min_probability=0.5)
+
+    """
+
+    def __init__(self, database: str = 'predictions.sqlite'):
+        """PredictionStore initializer. Creates the database if it does not exist.
+
+        Args:
+            database: Path to the SQLite database.
+
+        """
+        self._connection = sqlite3.connect(database, check_same_thread=False)
+        self._connection.executescript(
+            'CREATE TABLE IF NOT EXISTS predictions ('
+            'id INTEGER PRIMARY KEY AUTOINCREMENT, results TEXT NOT NULL, path TEXT NOT NULL, image TEXT, '
+            'predicted TEXT, probability REAL, flight TEXT, date TEXT, UNIQUE (results, path));'
+            'CREATE INDEX IF NOT EXISTS predictions_predicted ON predictions (predicted, probability);'
+            'CREATE INDEX IF NOT EXISTS predictions_probability ON predictions (probability);'
+            'CREATE INDEX IF NOT EXISTS predictions_flight ON predictions (flight, date);'
+            'CREATE INDEX IF NOT EXISTS predictions_date ON predictions (date);'
+        )
+        self._connection.commit()
+
+    def import_batch(self, output_dir: str, chunk_size: int = 10000) -> int:
+        """Adds the results of every finished flight of a batch run (see batch.BatchRunner) to the store.
+
+        Args:
+            output_dir: Output folder of the batch run.
+            chunk_size: Number of rows read and inserted at a time.
+
+        Returns:
+            Number of images imported.
+
+        """
+        count = 0
+        for filename in sorted(glob.glob(os.path.join(output_dir, '*', 'done.json'))):
+            with open(filename, encoding='utf-8') as f:
+                summary = json.load(f)
+            count += self.import_results(summary['results'], summary.get('flight'), chunk_size)
+
+        return count
+
+    def import_results(self, results_file: str, flight: Optional[str] = None, chunk_size: int = 10000) -> int:
+        """Adds the per image results of a results file to the store.
+
+        CSV files are read in chunks, so files of any size can be imported with bounded memory.
+
+        Args:
+            results_file: Path to a per image results CSV file or to an Excel results workbook.
+            flight: Flight the images belong to. None to take it from the batch run marker (done.json) next to the
+                    results file, if any.
+            chunk_size: Number of rows read and inserted at a time.
+
+        Returns:
+            Number of images imported.
+
+        """
+        done_filename = os.path.join(os.path.dirname(results_file), 'done.json')
+        if flight is None and os.path.exists(done_filename):
+            with open(done_filename, encoding='utf-8') as f:
+                flight = json.load(f).get('flight')
+
+        if results_file.endswith('.xlsx'):
+            chunks = [pd.read_excel(results_file, sheet_name='Classification results')]
+        else:
+            chunks = pd.read_csv(results_file, chunksize=chunk_size)
+
+        count = 0
+        for chunk in chunks:
+            rows = []
+            for image, predicted, folder_path, probability in chunk[['Image', 'Predicted', 'Folder_Path',
+                                                                     'probabilities']].itertuples(index=False):
+                timestamp = parse_filename(image)[1]
+                rows.append((results_file, folder_path + image, image, predicted, float(probability), flight,
+                             timestamp.date().isoformat() if timestamp else None))
+
+            self._connection.executemany(
+                'INSERT OR REPLACE INTO predictions (results, path, image, predicted, probability, flight, date) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?)', rows)
+            self._connection.commit()
+            count += len(rows)
+
+        return count
+
+    def query(self, predicted: str = "", min_probability: Optional[float] = None,
+              max_probability: Optional[float] = None, flight: str = "", date: str = "", page: int = 0,
+              page_size: int = 60) -> Tuple[List[Dict], int]:
+        """Lists a page of the stored predictions matching the filters.
+
+        Args:
+            predicted: Predicted class. Empty for any.
+            min_probability: Minimum probability of the 'defect' class.
+            max_probability: Maximum probability of the 'defect' class (excluded unless it is 1).
+            flight: Flight (path to the flight directory of a batch run). Empty for any.
+            date: Date of the thermographs (YYYY-MM-DD). Empty for any.
+            page: Page number (starting at 0).
+            page_size: Number of images per page.
+
+        Returns:
+            Predictions of the page, highest probability first.
+            Number of predictions matching the filters.
+
+        """
+        conditions, parameters = [], []
+        for column, value in (('predicted', predicted), ('flight', flight), ('date', date)):
+            if value:
+                conditions.append(column + ' = ?')
+                parameters.append(value)
+        if min_probability is not None:
+            conditions.append('probability >= ?')
+            parameters.append(min_probability)
+        if max_probability is not None:
+            conditions.append('probability <= ?' if max_probability >= 1 else 'probability < ?')
+            parameters.append(max_probability)
+        where = ' WHERE ' + ' AND '.join(conditions) if conditions else ''
+
+        total = self._connection.execute('SELECT COUNT(*) FROM predictions' + where, parameters).fetchone()[0]
+        cursor = self._connection.execute(
+            'SELECT id, path, image, predicted, probability, flight, date FROM predictions' + where +
+            ' ORDER BY probability DESC, id LIMIT ? OFFSET ?', parameters + [page_size, page * page_size])
+        columns = [description[0] for description in cursor.description]
+
+        return [dict(zip(columns, row)) for row in cursor.fetchall()], total
+
+    def values(self, column: str) -> List[str]:
+        """Lists the distinct values of a filter column ('predicted', 'flight' or 'date')."""
+        if column not in ('predicted', 'flight', 'date'):
+            raise ValueError("Column not supported. Possible values are 'predicted', 'flight' and 'date'.")
+
+        return [value for value, in self._connection.execute(
+            'SELECT DISTINCT {0} FROM predictions WHERE {0} IS NOT NULL ORDER BY {0}'.format(column))]
+
+    def path(self, prediction_id: int) -> Optional[str]:
+        """Returns the image path of a stored prediction."""
+        row = self._connection.execute('SELECT path FROM predictions WHERE id = ?', (prediction_id,)).fetchone()
+
+        return row[0] if row else None
+
+
+class ThumbnailCache:
+    """Class to generate image thumbnails once and serve them from disk."""
+
+    def __init__(self, cache_dir: str = 'thumbnails', size: int = 160):
+        """ThumbnailCache initializer.
+
+        Args:
+            cache_dir: Folder where the thumbnails are stored.
+            size: Maximum width and height of the thumbnails.
+
+        """
+        self._cache_dir = cache_dir
+        self._size = size
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def get(self, path: str) -> str:
+        """Returns the thumbnail of an image, generating it if the image is new or has changed.
+
+        Args:
+            path: Path to the image.
+
+        Returns:
+            Path to the thumbnail.
+
+        """
+        stat = os.stat(path)
+        key = '{}:{}:{}:{}'.format(os.path.abspath(path), stat.st_size, stat.st_mtime, self._size)
+        thumbnail = os.path.join(self._cache_dir, hashlib.sha1(key.encode('utf-8')).hexdigest() + '.jpg')
+
+        if not os.path.exists(thumbnail):
+            from PIL import Image
+
+            with Image.open(path) as image:
+                image.draft('RGB', (self._size, self._size))  # Lets the JPEG decoder skip most of the full image
+                image = image.convert('RGB')
+                image.thumbnail((self._size, self._size))
+                image.save(thumbnail + '.tmp', 'JPEG', quality=85)
+            os.replace(thumbnail + '.tmp', thumbnail)
+
+        return thumbnail
+
+
+def make_handler(store: PredictionStore, thumbnails: ThumbnailCache, page_size: int = 60):
+    """Creates the HTTP request handler of the viewer.
+
+    Args:
+        store: Prediction store.
+        thumbnails: Thumbnail cache.
+        page_size: Number of images per page.
+
+    Returns:
+        Request handler class.
+
+    """
+
+    class ViewerHandler(BaseHTTPRequestHandler):
+
+        def do_GET(self):
+            url = urlparse(self.path)
+            parameters = {key: values[0] for key, values in parse_qs(url.query).items()}
+
+            if url.path == '/':
+                self._send(200, 'text/html; charset=utf-8', self._page(parameters).encode('utf-8'))
+            elif url.path in ('/thumbnail', '/image'):
+                # Only images of stored predictions are served
+                path = store.path(int(parameters.get('id', 0)))
+                if path is None or not os.path.exists(path):
+                    self._send(404, 'text/plain', b'Not found')
+                    return
+                if url.path == '/thumbnail':
+                    path = thumbnails.get(path)
+                with open(path, 'rb') as f:
+                    self._send(200, 'image/jpeg', f.read(), cache=True)
+            else:
+                self._send(404, 'text/plain', b'Not found')
+
+        def _send(self, status: int, content_type: str, body: bytes, cache: bool = False):
+            self.send_response(status)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+            if cache:
+                self.send_header('Cache-Control', 'max-age=86400')
+            self.end_headers()
+            self.wfile.write(body)
+
+        def _page(self, parameters: Dict[str, str]) -> str:
+            page = max(0, int(parameters.get('page', 0)))
+            band = parameters.get('band', '')
+            low, high = (float(value) for value in band.split('-')) if band else (None, None)
+            rows, total = store.query(parameters.get('predicted', ''), low, high, parameters.get('flight', ''),
+                                      parameters.get('date', ''), page, page_size)
+
+            def select(name: str, options: List[Tuple[str, str]]) -> str:
+                items = ''.join('<option value="{}"{}>{}</option>'.format(
+                    html.escape(value), ' selected' if parameters.get(name, '') == value else '', html.escape(label))
+                    for value, label in [('', 'All')] + options)
+                return '<label>{} <select name="{}">{}</select></label> '.format(name.capitalize(), name, items)
+
+            form = ('<form>' + select('predicted', [(v, v) for v in store.values('predicted')]) +
+                    select('band', [('{}-{}'.format(lo, hi), 'P(defect) {:.0%}-{:.0%}'.format(lo, hi))
+                                    for lo, hi in PROBABILITY_BANDS]) +
+                    select('flight', [(v, v) for v in store.values('flight')]) +
+                    select('date', [(v, v) for v in store.values('date')]) +
+                    '<button>Filter</button></form>')
+
+            cards = ''.join(
+                '<a class="card" href="/image?id={id}" target="_blank"><img loading="lazy" src="/thumbnail?id={id}">'
+                '<div>{image}<br>{predicted} · P(defect) {probability:.2f}<br>{flight} · {date}</div></a>'.format(
+                    id=row['id'], image=html.escape(row['image']), predicted=html.escape(str(row['predicted'])),
+                    probability=row['probability'], flight=html.escape(str(row['flight'])),
+                    date=html.escape(str(row['date'])))
+                for row in rows)
+
+            def link(target: int, label: str) -> str:
+                query = dict(parameters, page=target)
+                return '<a href="/?{}">{}</a>'.format(html.escape(urlencode(query)), label)
+
+            pages = max(1, -(-total // page_size))
+            navigation = '{} images · page {} of {} {} {}'.format(
+                total, page + 1, pages, link(page - 1, '&larr; Previous') if page > 0 else '',
+                link(page + 1, 'Next &rarr;') if page + 1 < pages else '')
+
+            return ('<!DOCTYPE html><html><head><meta charset="utf-8"><title>Solar panel predictions</title><style>'
+                    'body{font-family:sans-serif;margin:1em}.card{display:inline-block;width:170px;margin:4px;'
+                    'font-size:11px;color:#222;text-decoration:none;vertical-align:top}.card img{max-width:160px}'
+                    '</style></head><body>' + form + '<p>' + navigation + '</p>' + cards + '<p>' + navigation +
+                    '</p></body></html>')
+
+        def log_message(self, format, *args):
+            pass
+
+    return ViewerHandler
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Browse stored prediction results.')
+    parser.add_argument('command', choices=('import', 'serve'))
+    parser.add_argument('results_files', nargs='*',
+                        help='Results CSV files, Excel workbooks or batch run output folders (import only).')
+    parser.add_argument('--flight', help='Flight of the imported results files (import only).')
+    parser.add_argument('--db', default='predictions.sqlite')
+    parser.add_argument('--thumbnails', default='thumbnails')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    arguments = parser.parse_args()
+
+    prediction_store = PredictionStore(arguments.db)
+    if arguments.command == 'import':
+        for results_file in arguments.results_files:
+            if os.path.isdir(results_file):
+                print(results_file, prediction_store.import_batch(results_file))
+            else:
+                print(results_file, prediction_store.import_results(results_file, arguments.flight))
+    else:
+        server = ThreadingHTTPServer((arguments.host, arguments.port),
+                                     make_handler(prediction_store, ThumbnailCache(arguments.thumbnails)))
+        print('Serving on http://{}:{}/'.format(arguments.host, arguments.port))
+        server.serve_forever()